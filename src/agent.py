@@ -1,50 +1,152 @@
+import contextlib
 import random
+import threading
+import numpy as np
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
 
-from replay_buffer import ReplayBuffer, PrioritizedReplayBuffer
+from replay_buffer import ReplayBuffer, PrioritizedReplayBuffer, ShardedPrioritizedReplayBuffer, states_to_tensor
+from profiler import NullTimer
+from target_update import TargetUpdater
+from prefetch import MinibatchPrefetcher
+
+
+@contextlib.contextmanager
+def eval_mode(net):
+    # runs net in eval mode for the duration, e.g. so a pass neither applies dropout nor updates BatchNorm statistics
+    training = net.training
+    net.eval()
+    try:
+        yield net
+    finally:
+        net.train(training)
 
 
 class DQNAgentBase:
+    double_q = False
+
     def __init__(self, net, target_net, action_dim=None, device=None, update_every=4, minibatch_size=64,
-                 tau=1e-3, gamma=0.99, lr=5e-4, **kwargs):
+                 tau=1e-3, gamma=0.99, lr=5e-4, target_update='soft', target_update_every=1, gradient_steps=1,
+                 prefetch_batches=0, precision='fp32', n_step=1, **kwargs):
         self.net = net
         self.target_net = target_net
         self.optimizer = torch.optim.Adam(self.net.parameters(), lr=lr)
         self.memory = None
+        # guards the replay buffer when actors and the learner run on different threads
+        self.memory_lock = threading.RLock()
+        # per-phase timing, replaced by a PhaseTimer when training is profiled
+        self.timer = NullTimer()
         self.__action_dim = action_dim
         self.device = device
         self.__step_i = 0
         self.__update_every = update_every
         self.__minibatch_size = minibatch_size
-        self.__tau = tau
+        self.__gradient_steps = gradient_steps
+        # if > 0, this many minibatches are sampled ahead on a background thread
+        self.__prefetch_batches = prefetch_batches
+        self.__prefetcher = None
+        self.__target_updater = TargetUpdater(net, target_net, tau=tau, mode=target_update,
+                                              every=target_update_every)
         self.gamma = gamma
+        # with n-step returns the replay buffer stores n-step transitions, whose targets bootstrap with gamma^n
+        self.__bootstrap_gamma = gamma ** n_step
+        # 'bf16' runs the forward passes under bfloat16 autocast; weights, gradients, optimizer state and the loss
+        # stay float32, and observations reach the network as float32 (uint8 frames are scaled on the device)
+        if precision not in ('fp32', 'bf16'):
+            raise KeyError('unknown precision')
+        self.__bf16 = precision == 'bf16'
+        # preallocated single-state network inputs, per thread since asynchronous actors act concurrently
+        self.__act_inputs = threading.local()
         pass
 
-    def act(self, state, eps):
-        with torch.no_grad():
-            action_values = self.net(torch.from_numpy(state).float().to(self.device))
+    def _autocast(self):
+        device_type = torch.device(self.device).type if self.device is not None else 'cpu'
+        return torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=self.__bf16)
+
+    def act(self, state, eps, net=None, device=None):
+        # net lets asynchronous actors act with their own synced copy of the online network, on their own device.
+        # The exploration draw comes first, so exploratory actions never pay for a forward pass.
         if random.random() < eps:
-            action = random.randint(0, self.__action_dim - 1)
-        else:
-            action = action_values.max(1)[1].item()
-        return action
+            return random.randint(0, self.__action_dim - 1)
+        net = self.net if net is None else net
+        device = self.device if device is None else device
+        with torch.no_grad(), self._autocast():
+            action_values = net(self._act_input(device, state))
+        return int(action_values.argmax(1))
+
+    def _act_input(self, device, state):
+        # copies state into this thread's preallocated input tensor for its device and shape; uint8 frames are
+        # scaled to [0, 1] in place
+        state = np.asarray(state)
+        inputs = getattr(self.__act_inputs, 'tensors', None)
+        if inputs is None:
+            inputs = self.__act_inputs.tensors = {}
+        key = (str(device), state.shape)
+        x = inputs.get(key)
+        if x is None:
+            x = inputs[key] = torch.empty(state.shape, dtype=torch.float32, device=device)
+        x.copy_(torch.from_numpy(state))
+        if state.dtype == np.uint8:
+            x.div_(255.)
+        return x
 
-    def step(self, state, action, reward, next_state, done):
-        self.memory.add(state, action, reward, next_state, done)
+    def act_batch(self, states, eps):
+        # epsilon-greedy actions of a batch of states, e.g. one per environment of a vectorized environment, with
+        # eps a scalar or one epsilon per state. Only the states that act greedily go through the network, in one
+        # forward pass.
+        n = len(states)
+        explore = np.random.random_sample(n) < eps
+        actions = np.random.randint(0, self.__action_dim, size=n)
+        greedy = np.flatnonzero(~explore)
+        if len(greedy):
+            with torch.no_grad(), self._autocast():
+                action_values = self.net(states_to_tensor(self.device, states[greedy]))
+            actions[greedy] = action_values.argmax(1).cpu().numpy()
+        return actions
+
+    def step(self, state, action, reward, next_state, done, env_id=0):
+        self.remember(state, action, reward, next_state, done, env_id)
         loss = 0
         self.__step_i += 1
-        if self.__step_i % self.__update_every == 0 and self.memory.size() > self.__minibatch_size:
-            # sample and train
-            samples = self.memory.sample()
-            loss = self._learn(samples)
+        if self.__step_i % self.__update_every == 0 and self.can_learn():
+            for _ in range(self.__gradient_steps):
+                loss += self.learn()
+        return loss
+
+    def remember(self, state, action, reward, next_state, done, env_id=0):
+        with self.timer.phase('buffer.add'), self.memory_lock:
+            self.memory.add(state, action, reward, next_state, done, env_id)
+
+    def can_learn(self):
+        return self.memory.size() > self.__minibatch_size
+
+    def learn(self):
+        # sample and train
+        with self.timer.phase('sample'):
+            samples = self._next_minibatch()
+        loss = self._learn(samples)
+        with self.timer.phase('target.update'):
             self.soft_update()
         return loss
 
+    def _next_minibatch(self):
+        if self.__prefetch_batches <= 0:
+            with self.memory_lock:
+                return self.memory.sample()
+        if self.__prefetcher is None:
+            self.__prefetcher = MinibatchPrefetcher(self.memory, self.device, lock=self.memory_lock,
+                                                    num_batches=self.__prefetch_batches)
+        return self.__prefetcher.next()
+
+    def close(self):
+        if self.__prefetcher is not None:
+            self.__prefetcher.stop()
+            self.__prefetcher = None
+        with self.memory_lock:
+            self.memory.flush()
+
     def soft_update(self):
-        for target_param, local_param in zip(self.target_net.parameters(), self.net.parameters()):
-            target_param.data.copy_(self.__tau*local_param.data + (1.0-self.__tau)*target_param.data)
+        self.__target_updater.update()
 
     def save(self, fname):
         ckpt = {'net': self.net,
@@ -57,11 +159,66 @@ class DQNAgentBase:
 
     @classmethod
     def load(cls, fname):
-        ckpt = torch.load(fname)
+        # agents are saved as whole modules, which torch.load only unpickles with weights_only=False
+        ckpt = torch.load(fname, weights_only=False)
         obj = cls(ckpt['net'], ckpt['target_net'], action_dim=ckpt['action_dim'], device=ckpt['device'])
         return obj
 
+    def state_dict(self):
+        # complete learner state for resuming training; the replay buffer is read under the memory lock, which only
+        # takes as long as copying the transitions added since the previous checkpoint
+        with self.memory_lock:
+            memory = self.memory.state_dict()
+        return {'net': self.net.state_dict(),
+                'target_net': self.target_net.state_dict(),
+                'optimizer': self.optimizer.state_dict(),
+                'step_i': self.__step_i,
+                'target_updater': self.__target_updater.state_dict(),
+                'memory': memory}
+
+    def load_state_dict(self, state):
+        self.net.load_state_dict(state['net'])
+        self.target_net.load_state_dict(state['target_net'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        self.__step_i = state['step_i']
+        self.__target_updater.load_state_dict(state['target_updater'])
+        with self.memory_lock:
+            self.memory.load_state_dict(state['memory'])
+
     def _learn(self, samples):
+        # shared loss engine: subclasses pick the target (double_q) and may reweight the loss and
+        # consume the TD errors (prioritized replay)
+        states, actions, rewards, next_states, dones = samples[:5]
+        with self.timer.phase('forward'), self._autocast():
+            # under bf16 autocast the Q-values come out as bfloat16; the TD errors and the loss are float32
+            expected_q_values = self.net(states, training=True).float().gather(1, actions)
+            # targets never need gradients; the next-state pass of the online network is kept out of the
+            # graph as well, since batching it with the states would make the backward pass twice as wide
+            with torch.no_grad():
+                if self.double_q:
+                    # Double DQN target: online network picks the action, target network evaluates it; the pick
+                    # runs in eval mode, so it neither drops units nor moves the BatchNorm statistics
+                    with eval_mode(self.net):
+                        next_a = self.net(next_states).max(1)[1].unsqueeze(1)
+                    target_q_values_next = self.target_net(next_states).float().gather(1, next_a)
+                else:
+                    # DQN target
+                    target_q_values_next = self.target_net(next_states).float().max(1)[0].unsqueeze(1)
+            target_q_values = rewards + self.__bootstrap_gamma * target_q_values_next * (1 - dones)
+            td_err = expected_q_values - target_q_values  # calc td error
+            loss = self._loss(td_err, samples)
+        with self.timer.phase('backward'):
+            self.optimizer.zero_grad()
+            loss.backward()
+        with self.timer.phase('optimizer.step'):
+            self.optimizer.step()
+        self._after_learn(td_err, samples)
+        return loss.detach().cpu().numpy()
+
+    def _loss(self, td_err, samples):
+        return td_err.pow(2).mean()
+
+    def _after_learn(self, td_err, samples):
         pass
 
     def decay_learning_rate(self, decay):
@@ -75,101 +232,54 @@ class DQNAgentBase:
 class DQNAgent(DQNAgentBase):
     def __init__(self, net, target_net, **kwargs):
         super(DQNAgent, self).__init__(net, target_net, **kwargs)
-        self.memory = ReplayBuffer(**kwargs)
+        self.memory = ReplayBuffer(**dict(kwargs, gamma=self.gamma))
 
-    def _learn(self, samples):
-        states, actions, rewards, next_states, dones = samples
-        expected_q_values = self.net(states, training=True).gather(1, actions)
-        # DQN target
-        target_q_values_next = self.target_net(next_states, training=True).detach().max(1)[0].unsqueeze(1)
-        target_q_values = rewards + (self.gamma * target_q_values_next * (1 - dones))
-        loss = F.mse_loss(expected_q_values, target_q_values)
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
-        return loss.detach().cpu().numpy()
 
-
-class DDQNAgent(DQNAgentBase):
-    def __init__(self, net, target_net, **kwargs):
-        super(DDQNAgent, self).__init__(net, target_net, **kwargs)
-        self.memory = ReplayBuffer(**kwargs)
-
-    def _learn(self, samples):
-        states, actions, rewards, next_states, dones = samples
-        expected_q_values = self.net(states, training=True).gather(1, actions.view(-1, 1))
-        # Double DQN target
-        next_a = self.net(next_states, training=True).max(1)[1].unsqueeze(1)
-        target_q_values = rewards + self.gamma * self.target_net(next_states).gather(1, next_a).detach() * (1-dones)
-        loss = F.mse_loss(expected_q_values, target_q_values)
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
-        return loss.detach().cpu().numpy()
+class DDQNAgent(DQNAgent):
+    double_q = True
 
 
 class DQNAgentPER(DQNAgentBase):
-    def __init__(self, net, target_net, alpha=0.6, beta=0.4, beta_delta=1.001, e=1e-8, **kwargs):
+    def __init__(self, net, target_net, alpha=0.6, beta=0.4, beta_delta=1.001, e=1e-8, replay_shards=1, **kwargs):
         super(DQNAgentPER, self).__init__(net, target_net, **kwargs)
-        self.memory = PrioritizedReplayBuffer(**kwargs)
+        if replay_shards > 1:
+            self.memory = ShardedPrioritizedReplayBuffer(num_shards=replay_shards, **dict(kwargs, gamma=self.gamma))
+        else:
+            self.memory = PrioritizedReplayBuffer(**dict(kwargs, gamma=self.gamma))
         self.__alpha = alpha
         self.__beta = beta
         self.__beta_delta = beta_delta
         self.__e = e
 
-    def _learn(self, samples):
-        states, actions, rewards, next_states, dones, idxs, probs = samples
-        expected_q_values = self.net(states, training=True).gather(1, actions)
-        # DQN target
-        target_q_values_next = self.target_net(next_states, training=True).detach().max(1)[0].unsqueeze(1)
-        target_q_values = rewards + self.gamma * target_q_values_next * (1 - dones)
-        td_err = expected_q_values - target_q_values  # calc td error
+    def _loss(self, td_err, samples):
+        probs = samples[6]
+        # importance sampling weights
         weights = (probs * self.memory.size()).pow(-self.__beta).to(self.device)
         weights = weights / weights.max()
-        loss = torch.mean(td_err.pow(2).squeeze() * weights)
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
-        self.memory.update(idxs.cpu().numpy(),
-                             td_err.abs().detach().cpu().numpy().squeeze() ** self.__alpha + self.__e)
-        return loss.detach().cpu().numpy()
+        return torch.mean(td_err.pow(2).squeeze(1) * weights)
+
+    def _after_learn(self, td_err, samples):
+        idxs = samples[5]
+        # idxs stay a NumPy array so the whole minibatch goes back to the sum-tree in one batched update
+        with self.timer.phase('priority.update'):
+            priorities = td_err.detach().abs().pow(self.__alpha).add(self.__e).view(-1).cpu().numpy()
+            with self.memory_lock:
+                self.memory.update(idxs, priorities)
 
-    def step(self, state, action, reward, next_state, done):
-        loss = super(DQNAgentPER, self).step(state, action, reward, next_state, done)
+    def remember(self, state, action, reward, next_state, done, env_id=0):
+        super(DQNAgentPER, self).remember(state, action, reward, next_state, done, env_id)
         if done:
             self.__beta = min(1., self.__beta * self.__beta_delta)
-        return loss
 
+    def state_dict(self):
+        state = super(DQNAgentPER, self).state_dict()
+        state['beta'] = self.__beta
+        return state
 
-class DDQNAgentPER(DQNAgentBase):
-    def __init__(self, net, target_net,  alpha=0.6, beta=0.4, beta_delta=1.001, e=1e-8, **kwargs):
-        super(DDQNAgentPER, self).__init__(net, target_net, **kwargs)
-        self.memory = PrioritizedReplayBuffer(**kwargs)
-        self.__alpha = alpha
-        self.__beta = beta
-        self.__beta_delta = beta_delta
-        self.__e = e
+    def load_state_dict(self, state):
+        super(DQNAgentPER, self).load_state_dict(state)
+        self.__beta = state['beta']
 
-    def _learn(self, samples):
-        states, actions, rewards, next_states, dones, idxs, probs = samples
-        expected_q_values = self.net(states, training=True).gather(1, actions)
-        # DDQN target
-        next_a = self.net(next_states, training=True).max(1)[1].unsqueeze(1)
-        target_q_values = rewards + \
-                          self.gamma * self.target_net(next_states).gather(1, next_a) * (1 - dones)
-        td_err = expected_q_values - target_q_values  # calc td error
-        weights = (probs * self.memory.size()).pow(-self.__beta).to(self.device)
-        weights = weights / weights.max()
-        loss = torch.mean(td_err.pow(2).squeeze() * weights)
-        self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
-        self.memory.update(idxs.cpu().numpy(),
-                             td_err.abs().detach().cpu().numpy().squeeze() ** self.__alpha + self.__e)
-        return loss.detach().cpu().numpy()
 
-    def step(self, state, action, reward, next_state, done):
-        loss = super(DDQNAgentPER, self).step(state, action, reward, next_state, done)
-        if done:
-            self.__beta = min(1., self.__beta * self.__beta_delta)
-        return loss
+class DDQNAgentPER(DQNAgentPER):
+    double_q = True
@@ -0,0 +1,367 @@
+from environment import SimBananaEnvironment, BatchedSimBananaEnvironment
+from agent import DQNAgent, DDQNAgent, DQNAgentPER, DDQNAgentPER
+from replay_buffer import ReplayBuffer, PrioritizedReplayBuffer, ShardedPrioritizedReplayBuffer, \
+    SharedMemoryAllocator
+from neural_net import MlpQNetwork, ConvQNetwork
+from dqn import DQN
+from quantize import quantize_net, action_agreement
+from profiler import measure
+import argparse
+import copy
+import json
+import multiprocessing as mp
+import os
+import platform
+import random
+import sys
+import time
+import numpy as np
+import torch
+
+AGENTS = {'dqn': DQNAgent, 'ddqn': DDQNAgent, 'dqn_PER': DQNAgentPER, 'ddqn_PER': DDQNAgentPER}
+
+
+def random_transition(state_shape):
+    return (np.random.rand(*state_shape), random.randint(0, 3), float(random.randint(-1, 1)),
+            np.random.rand(*state_shape), random.random() < 0.01)
+
+
+def fill(memory, state_shape, n):
+    for _ in range(n):
+        memory.add(*random_transition(state_shape))
+
+
+def bench_buffers(results, buffer_sizes, batch_sizes, num_iters, replay_shards=()):
+    state_shape = (1, 37)
+    configs = [(ReplayBuffer, {}), (PrioritizedReplayBuffer, {})]
+    configs += [(ShardedPrioritizedReplayBuffer, {'num_shards': k}) for k in replay_shards]
+    for buffer_cls, extra in configs:
+        prioritized = buffer_cls is not ReplayBuffer
+        for buffer_size in buffer_sizes:
+            for batch_size in batch_sizes:
+                params = dict({'buffer_size': buffer_size, 'batch_size': batch_size}, **extra)
+                memory = buffer_cls(buffer_size=buffer_size, minibatch_size=batch_size, device='cpu', **extra)
+                fill(memory, state_shape, buffer_size)
+                transition = random_transition(state_shape)
+                results.append(dict(name=buffer_cls.__name__ + '.add', params=params,
+                                    **measure(lambda: memory.add(*transition), num_iters * 10)))
+                if prioritized:
+                    memory.sample()  # flush the pending transitions into the sum-tree
+                results.append(dict(name=buffer_cls.__name__ + '.sample', params=params,
+                                    **measure(memory.sample, num_iters)))
+                if prioritized:
+                    idxs = np.random.randint(0, buffer_size, batch_size)
+                    keys = np.random.rand(batch_size)
+                    results.append(dict(name=buffer_cls.__name__ + '.update', params=params,
+                                        **measure(lambda: memory.update(idxs, keys), num_iters)))
+
+
+def make_nets(visual, state_dim):
+    if visual:
+        return ConvQNetwork(state_dim, 4), ConvQNetwork(state_dim, 4)
+    return MlpQNetwork(state_dim, 4), MlpQNetwork(state_dim, 4)
+
+
+BUFFERS = {'ReplayBuffer': ReplayBuffer, 'PrioritizedReplayBuffer': PrioritizedReplayBuffer,
+           'ShardedPrioritizedReplayBuffer': ShardedPrioritizedReplayBuffer}
+
+
+def _shared_writer(buffer_name, buffer_kwargs, env_id, n, barrier, elapsed):
+    # adds n transitions in place into a buffer on shared memory
+    memory = BUFFERS[buffer_name](**buffer_kwargs)
+    transitions = [random_transition((1, 37)) for _ in range(n)]
+    barrier.wait()
+    start = time.perf_counter()
+    for transition in transitions:
+        memory.add(*transition, env_id=env_id)
+    elapsed.put(time.perf_counter() - start)
+
+
+def _pipe_writer(transitions_queue, n, barrier):
+    # sends n transitions to the process owning the buffer
+    transitions = [random_transition((1, 37)) for _ in range(n)]
+    barrier.wait()
+    for transition in transitions:
+        transitions_queue.put(transition)
+
+
+def bench_shared(results, buffer_sizes, num_writers, num_transitions, replay_shards=()):
+    # transitions/sec that writer processes get into one replay buffer: added in place into shared memory, or
+    # pickled through a queue to the process owning an in-process buffer. Sharded buffers get one shared-memory
+    # allocator, and so one lock, per shard.
+    ctx = mp.get_context('spawn')
+    configs = [('ReplayBuffer', {}), ('PrioritizedReplayBuffer', {})]
+    configs += [('ShardedPrioritizedReplayBuffer', {'num_shards': k}) for k in replay_shards]
+    for buffer_name, extra in configs:
+        buffer_cls = BUFFERS[buffer_name]
+        for buffer_size in buffer_sizes:
+            for k in num_writers:
+                params = dict({'buffer_size': buffer_size, 'writers': k}, **extra)
+                n = num_transitions // k
+                if 'num_shards' in extra:
+                    allocators = [SharedMemoryAllocator() for _ in range(extra['num_shards'])]
+                    allocator_kwargs = {'allocators': allocators}
+                else:
+                    allocators = [SharedMemoryAllocator()]
+                    allocator_kwargs = {'allocator': allocators[0]}
+                buffer_kwargs = dict(buffer_size=buffer_size, device='cpu', state_shape=(37,), **extra,
+                                     **allocator_kwargs)
+                memory = buffer_cls(**buffer_kwargs)
+                barrier, elapsed = ctx.Barrier(k), ctx.Queue()
+                writers = [ctx.Process(target=_shared_writer, args=(buffer_name, buffer_kwargs, i, n, barrier, elapsed))
+                           for i in range(k)]
+                for writer in writers:
+                    writer.start()
+                times = [elapsed.get() for _ in writers]
+                for writer in writers:
+                    writer.join()
+                results.append(dict(name=buffer_name + '.shared_add', params=params,
+                                    ops_per_sec=k * n / max(times), size=memory.size()))
+                del memory
+                for allocator in allocators:
+                    allocator.close()
+
+                memory = buffer_cls(buffer_size=buffer_size, device='cpu', **extra)
+                barrier, transitions_queue = ctx.Barrier(k + 1), ctx.Queue(maxsize=10000)
+                writers = [ctx.Process(target=_pipe_writer, args=(transitions_queue, n, barrier)) for _ in range(k)]
+                for writer in writers:
+                    writer.start()
+                barrier.wait()
+                start = time.perf_counter()
+                for _ in range(k * n):
+                    memory.add(*transitions_queue.get())
+                results.append(dict(name=buffer_name + '.pipe_add', params=params,
+                                    ops_per_sec=k * n / (time.perf_counter() - start)))
+                for writer in writers:
+                    writer.join()
+
+
+def bench_networks(results, batch_sizes, num_iters, visual):
+    state_dim = np.array([1, 3, 4, 84, 84]) if visual else 37
+    state_shape = tuple(state_dim) if visual else (1, 37)
+    net, _ = make_nets(visual, state_dim)
+    name = type(net).__name__
+    for batch_size in batch_sizes:
+        params = {'batch_size': batch_size}
+        x = torch.rand((batch_size,) + state_shape[1:])
+
+        def forward():
+            with torch.no_grad():
+                net(x)
+
+        def forward_backward():
+            net.zero_grad()
+            net(x, training=True).sum().backward()
+
+        results.append(dict(name=name + '.forward', params=params, **measure(forward, num_iters)))
+        results.append(dict(name=name + '.forward_backward', params=params, **measure(forward_backward, num_iters)))
+
+
+def bench_quantized(results, batch_sizes, num_iters, visual):
+    # float vs int8 inference of the online network, with the greedy action agreement of each int8 copy
+    state_dim = np.array([1, 3, 4, 84, 84]) if visual else 37
+    state_shape = tuple(state_dim) if visual else (1, 37)
+    net, _ = make_nets(visual, state_dim)
+    name = type(net).__name__
+    calibration_states = torch.rand((16,) + state_shape[1:])
+    eval_states = torch.rand((64 if visual else 1024,) + state_shape[1:])
+    nets = {'fp32': copy.deepcopy(net).eval(),
+            'int8_dynamic': quantize_net(net, 'dynamic'),
+            'int8_static': quantize_net(net, 'static', calibration_states)}
+    for mode, qnet in nets.items():
+        agreement = action_agreement(net, qnet, eval_states)
+        for batch_size in batch_sizes:
+            x = torch.rand((batch_size,) + state_shape[1:])
+
+            def forward():
+                with torch.no_grad():
+                    qnet(x)
+
+            results.append(dict(name=name + '.forward', params={'batch_size': batch_size, 'precision': mode},
+                                action_agreement=agreement, **measure(forward, num_iters)))
+
+
+def precision_params(precision):
+    # fp32 results keep the parameters they had before precisions were benchmarked, so old baselines still match
+    return {} if precision == 'fp32' else {'precision': precision}
+
+
+def bench_agents(results, batch_sizes, num_iters, visual, precision='fp32'):
+    state_dim = np.array([1, 3, 4, 84, 84]) if visual else 37
+    state_shape = tuple(state_dim) if visual else (1, 37)
+    env_type = 'visual' if visual else 'simple'
+    for agent_name, agent_cls in AGENTS.items():
+        for batch_size in batch_sizes:
+            params = dict({'batch_size': batch_size, 'env_type': env_type}, **precision_params(precision))
+            net, target_net = make_nets(visual, state_dim)
+            agent = agent_cls(net, target_net, action_dim=4, device='cpu', minibatch_size=batch_size,
+                              buffer_size=max(10 * batch_size, 1000), env_type=env_type, precision=precision)
+            fill(agent.memory, state_shape, max(10 * batch_size, 1000))
+            samples = agent.memory.sample()
+            if isinstance(agent.memory, PrioritizedReplayBuffer):
+                # the first prioritized minibatch also carries every pending transition
+                samples = agent.memory.sample()
+            results.append(dict(name=agent_cls.__name__ + '._learn', params=params,
+                                **measure(lambda: agent._learn(samples), num_iters)))
+            if agent_name == 'dqn':
+                state = np.random.rand(*state_shape)
+                for eps in (0., 1.):
+                    results.append(dict(name='DQNAgentBase.act',
+                                        params=dict({'env_type': env_type, 'eps': eps}, **precision_params(precision)),
+                                        **measure(lambda: agent.act(state, eps), num_iters * 10)))
+                # one call for a vectorized environment of 8, half of the actions exploratory
+                states = np.random.rand(*((8,) + state_shape[1:]))
+                results.append(dict(name='DQNAgentBase.act_batch',
+                                    params=dict({'env_type': env_type, 'num_envs': 8, 'eps': 0.5},
+                                                **precision_params(precision)),
+                                    **measure(lambda: agent.act_batch(states, 0.5), num_iters * 10)))
+                if precision == 'fp32':
+                    results.append(dict(name='DQNAgentBase.soft_update', params={'env_type': env_type},
+                                        **measure(agent.soft_update, num_iters * 10)))
+
+
+def bench_train(results, num_episodes, num_envs, visual, precision='fp32'):
+    env_type = 'visual' if visual else 'simple'
+    # pixel runs keep their frames as uint8 from the environment to the device
+    frame_dtype = np.uint8 if visual else np.float32
+    if num_envs > 1:
+        env = BatchedSimBananaEnvironment(num_envs=num_envs, visual=visual, dtype=frame_dtype)
+    else:
+        env = SimBananaEnvironment(visual=visual, dtype=frame_dtype)
+    net, target_net = make_nets(visual, env.get_state_dim())
+    agent = DDQNAgent(net, target_net, action_dim=env.get_action_dim(), device='cpu', env_type=env_type,
+                      precision=precision)
+    dqn = DQN(env=env, agent=agent)
+    start = time.perf_counter()
+    scores, _ = dqn.train(num_episodes, target_score=np.inf, verbose=0)
+    elapsed = time.perf_counter() - start
+    # every simulated episode is 300 steps long
+    results.append({'name': 'DQN.train',
+                    'params': dict({'env_type': env_type, 'num_envs': num_envs}, **precision_params(precision)),
+                    'env_steps_per_sec': num_episodes * 300 / elapsed, 'episodes': num_episodes,
+                    'mean_score': float(np.mean(scores))})
+    env.close()
+
+
+def result_key(result):
+    return result['name'] + json.dumps(result['params'], sort_keys=True)
+
+
+def throughput(result):
+    return result.get('ops_per_sec', result.get('env_steps_per_sec'))
+
+
+def compare(results, baseline, tolerance):
+    # a result regresses when its throughput drops by more than tolerance relative to the baseline
+    baseline = {result_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        ref = baseline.get(result_key(result))
+        if ref is None:
+            continue
+        ratio = throughput(result) / throughput(ref)
+        result['baseline_ratio'] = ratio
+        if ratio < 1 - tolerance:
+            regressions.append(result)
+    return regressions
+
+
+def run(**kwargs):
+    torch.manual_seed(0)
+    random.seed(0)
+    np.random.seed(0)
+    all_results = []
+    for num_threads in kwargs['threads']:
+        torch.set_num_threads(num_threads)
+        results = []
+        if 'buffers' in kwargs['suites']:
+            bench_buffers(results, kwargs['buffer_sizes'], kwargs['batch_sizes'], kwargs['num_iters'],
+                          kwargs['replay_shards'])
+        if 'shared' in kwargs['suites']:
+            bench_shared(results, kwargs['buffer_sizes'], kwargs['num_writers'], kwargs['shared_transitions'],
+                         kwargs['replay_shards'])
+        if 'networks' in kwargs['suites']:
+            bench_networks(results, kwargs['batch_sizes'], kwargs['num_iters'], visual=False)
+            if kwargs['visual']:
+                bench_networks(results, kwargs['batch_sizes'], max(kwargs['num_iters'] // 10, 1), visual=True)
+        if 'quantized' in kwargs['suites']:
+            bench_quantized(results, kwargs['batch_sizes'], kwargs['num_iters'], visual=False)
+            if kwargs['visual']:
+                bench_quantized(results, kwargs['batch_sizes'], max(kwargs['num_iters'] // 10, 1), visual=True)
+        for precision in kwargs['precisions']:
+            if 'agents' in kwargs['suites']:
+                bench_agents(results, kwargs['batch_sizes'], kwargs['num_iters'], visual=False, precision=precision)
+                if kwargs['visual']:
+                    bench_agents(results, kwargs['batch_sizes'], max(kwargs['num_iters'] // 10, 1), visual=True,
+                                 precision=precision)
+            if 'train' in kwargs['suites']:
+                for num_envs in kwargs['num_envs']:
+                    bench_train(results, kwargs['train_episodes'], num_envs, visual=False, precision=precision)
+                    if kwargs['visual']:
+                        bench_train(results, kwargs['train_episodes'], num_envs, visual=True, precision=precision)
+        for result in results:
+            result['params']['threads'] = num_threads
+        all_results.extend(results)
+
+    report = {'machine': {'python': platform.python_version(), 'torch': torch.__version__,
+                          'processor': platform.processor(), 'platform': platform.platform()},
+              'results': all_results}
+    regressions = []
+    if kwargs['baseline'] and os.path.exists(kwargs['baseline']):
+        with open(kwargs['baseline']) as f:
+            baseline = json.load(f)
+        if baseline['machine'] != report['machine']:
+            print('note: {} was measured on another machine ({})'.format(kwargs['baseline'],
+                                                                        baseline['machine']['platform']))
+        regressions = compare(all_results, baseline, kwargs['tolerance'])
+        report['regressions'] = [result_key(r) for r in regressions]
+    elif kwargs['baseline']:
+        print('note: no baseline at {}, nothing to compare against'.format(kwargs['baseline']))
+
+    with open(kwargs['output'], 'w') as f:
+        json.dump(report, f, indent=1)
+    for result in all_results:
+        ratio = ' | x{:.2f} vs baseline'.format(result['baseline_ratio']) if 'baseline_ratio' in result else ''
+        print('{:45s} {:70s} {:12.1f}/s{}'.format(result['name'], json.dumps(result['params']), throughput(result),
+                                                  ratio))
+    for result in regressions:
+        print('REGRESSION: {} {}'.format(result['name'], json.dumps(result['params'])))
+    return report, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--suites', type=str, nargs='+',
+                        default=['buffers', 'networks', 'quantized', 'agents', 'train'],
+                        help='benchmark suites to run: buffers, shared, networks, quantized, agents, train')
+    parser.add_argument('--buffer_sizes', type=int, nargs='+', default=[10000, 100000],
+                        help='replay buffer sizes')
+    parser.add_argument('--num_writers', type=int, nargs='+', default=[1, 2, 4],
+                        help='writer process counts of the shared-memory replay benchmark')
+    parser.add_argument('--shared_transitions', type=int, default=40000,
+                        help='transitions written in total per shared-memory replay benchmark')
+    parser.add_argument('--replay_shards', type=int, nargs='+', default=[4],
+                        help='shard counts of the sharded prioritized replay buffer in the buffers and shared suites')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[64],
+                        help='minibatch sizes')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1],
+                        help='torch intra-op thread counts')
+    parser.add_argument('--num_iters', type=int, default=200,
+                        help='timed iterations per micro-benchmark')
+    parser.add_argument('--visual', action='store_true',
+                        help='also benchmark ConvQNetwork and visual agents (slow on CPU)')
+    parser.add_argument('--precisions', type=str, nargs='+', default=['fp32'], choices=['fp32', 'bf16'],
+                        help='training precisions of the agents and train suites')
+    parser.add_argument('--num_envs', type=int, nargs='+', default=[1],
+                        help='simulated environment counts for the end-to-end DQN.train benchmark')
+    parser.add_argument('--train_episodes', type=int, default=2,
+                        help='episodes of DQN.train in the end-to-end benchmark')
+    parser.add_argument('--output', type=str, default='benchmark.json',
+                        help='file to write the JSON results to')
+    parser.add_argument('--baseline', type=str, default='../benchmarks/baseline.json',
+                        help='JSON results of a previous run to compare against ("" to skip the comparison)')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative throughput drop before a result counts as a regression')
+    args = parser.parse_args()
+    _, regressions = run(**vars(args))
+    sys.exit(1 if regressions else 0)
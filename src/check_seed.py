@@ -2,20 +2,20 @@ from environment import VisualBananaEnvironment, BananaEnvironment
 from agent import DQNAgent, DDQNAgent, DQNAgentPER, DDQNAgentPER
 from neural_net import MlpQNetwork, ConvQNetwork
 from dqn import DQN
+from trajectory import TrajectoryWriter
 import argparse
 import random
 import matplotlib.pyplot as plt
 import torch
 import datetime
-import numpy as np
+import shutil
 import matplotlib as mpl
-import numpy as np
 
 def train(agent, env):
     # import random
-    buffers = []
-
-    buffer = []
+    # every run records afresh
+    shutil.rmtree('buffer_1', ignore_errors=True)
+    buffer = TrajectoryWriter('buffer_1')
     for i in range(1, 200):
 
         state = env.reset()
@@ -27,11 +27,11 @@ def train(agent, env):
             action = random.randint(0, 3)
             next_state, reward, done = env.step(action)  # roll out transition
             loss += agent.step(state, action, reward, next_state, done)  # agent's update routine
-            buffer.append((state, action, reward, next_state, done))
+            buffer.add(state, action, reward, next_state, done)
             score += reward
             state = next_state
         print(i, score)
-    np.save('buffer_1', buffer)
+    buffer.close()
 
     return
 
@@ -1,14 +1,19 @@
 import numpy as np
+from trajectory import TrajectoryReader
 
-bf0 = np.load('buffer_0.npy')
-bf1 = np.load('buffer_1.npy')
+bf0 = TrajectoryReader('buffer_0')
+bf1 = TrajectoryReader('buffer_1')
 
-for i, v in enumerate(bf0):
-
-    equal = (bf1[i][2] == bf0[i][2])
-    equal = equal and (bf1[i][1] == bf0[i][1]) and (np.sum(abs(bf1[i][0] - bf0[i][0])) < 0.000001)
-    if not equal:
-        print(i)
-        print(equal)
-        print(bf1[i][2], bf0[2])
-    # print(bf1[i] == bf0[i])
+# compares the two recordings chunk by chunk, so neither has to fit into memory
+offset = 0
+for c0, c1 in zip(bf0.chunks(), bf1.chunks()):
+    states0, actions0, rewards0 = c0[:3]
+    states1, actions1, rewards1 = c1[:3]
+    n = min(len(actions0), len(actions1))
+    equal = (rewards1[:n] == rewards0[:n]) & (actions1[:n] == actions0[:n]) & \
+            (np.abs(states1[:n] - states0[:n]).reshape(n, -1).sum(1) < 0.000001)
+    for i in np.flatnonzero(~equal):
+        print(offset + i)
+        print(equal[i])
+        print(rewards1[i], rewards0[i])
+    offset += n
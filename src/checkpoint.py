@@ -0,0 +1,147 @@
+import glob
+import os
+import queue
+import random
+import re
+import threading
+import numpy as np
+import torch
+
+
+class ArrayDelta:
+    # The rows idxs of a large array (e.g. a replay buffer column) that changed since the previous checkpoint, as
+    # array[idxs] = rows. CheckpointWriter keeps the whole array on disk next to the checkpoints and load_checkpoint
+    # puts it back in place of the delta, so a checkpoint costs the training thread a copy of the new rows only.
+    def __init__(self, shape, dtype, idxs, rows):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.idxs = np.asarray(idxs, dtype=np.int64)
+        self.rows = rows
+
+
+def map_deltas(state, fn, path=()):
+    # the nested state dict with every ArrayDelta replaced by fn(path, delta)
+    if isinstance(state, ArrayDelta):
+        return fn(path, state)
+    if isinstance(state, dict):
+        return {k: map_deltas(v, fn, path + (str(k),)) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(map_deltas(v, fn, path + (str(i),)) for i, v in enumerate(state))
+    return state
+
+
+def apply_delta(directory, path, delta):
+    # Brings the array kept for path in directory/arrays up to date with delta and returns it. Applying a delta
+    # twice is harmless, so a checkpoint whose deltas were only partly applied before a crash is completed by
+    # applying them again.
+    fname = os.path.join(directory, 'arrays', '.'.join(path) + '.npy')
+    array = np.load(fname, mmap_mode='r+') if os.path.exists(fname) else None
+    if array is None or array.shape != delta.shape or array.dtype != delta.dtype:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        array = np.lib.format.open_memmap(fname, mode='w+', shape=delta.shape, dtype=delta.dtype)
+    array[delta.idxs] = delta.rows
+    array.flush()
+    return array
+
+
+def snapshot(state):
+    # detached CPU copy of the tensors in a nested state dict, so training can go on updating the parameters while
+    # it is written; the replay buffers already hand out copies of their NumPy arrays and deltas
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {k: snapshot(v) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(v) for v in state)
+    return state
+
+
+def rng_state():
+    state = {'random': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['random'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def checkpoint_fname(directory, step):
+    return os.path.join(directory, 'checkpoint_{:08d}.pt'.format(step))
+
+
+def latest_checkpoint(directory):
+    # newest complete checkpoint in directory, or None; partially written files never carry the final name
+    fnames = glob.glob(os.path.join(directory, 'checkpoint_*.pt'))
+    steps = [int(re.search(r'checkpoint_(\d+)\.pt$', fname).group(1)) for fname in fnames]
+    return checkpoint_fname(directory, max(steps)) if steps else None
+
+
+def load_checkpoint(fname):
+    # Checkpoints hold NumPy arrays and RNG states next to the tensors, so they are not weights-only files. Array
+    # deltas come back as the whole arrays, memory-mapped from the checkpoint directory; these are only kept for
+    # the latest checkpoint.
+    state = torch.load(fname, map_location='cpu', weights_only=False)
+    directory = os.path.dirname(fname)
+    return map_deltas(state, lambda path, delta: apply_delta(directory, path, delta))
+
+
+class CheckpointWriter:
+    # Writes training states to directory on a background thread. save() only takes a CPU snapshot of the state,
+    # serialization and the disk write happen off the training thread. Every file is written under a temporary
+    # name and renamed when complete, so a crash never leaves a truncated latest checkpoint; the array deltas of a
+    # checkpoint are applied to the arrays in directory/arrays once its file is complete. At most one snapshot
+    # waits behind the one being written; the `keep` newest checkpoints are kept, but only the latest one can be
+    # resumed from once the arrays have moved on.
+    def __init__(self, directory, keep=2):
+        self.__directory = directory
+        self.__keep = keep
+        self.__queue = queue.Queue(maxsize=1)
+        self.__error = None
+        os.makedirs(directory, exist_ok=True)
+        self.__thread = threading.Thread(target=self._run, daemon=True)
+        self.__thread.start()
+
+    def _run(self):
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                return
+            step, state = item
+            try:
+                fname = checkpoint_fname(self.__directory, step)
+                torch.save(state, fname + '.tmp')
+                os.replace(fname + '.tmp', fname)
+                map_deltas(state, lambda path, delta: apply_delta(self.__directory, path, delta))
+                self._prune()
+            except Exception as e:
+                self.__error = e
+            finally:
+                self.__queue.task_done()
+
+    def _prune(self):
+        fnames = sorted(glob.glob(os.path.join(self.__directory, 'checkpoint_*.pt')))
+        for fname in fnames[:max(len(fnames) - self.__keep, 0)]:
+            os.remove(fname)
+
+    def _check(self):
+        if self.__error is not None:
+            raise self.__error
+
+    def save(self, state, step):
+        self._check()
+        self.__queue.put((step, snapshot(state)))
+
+    def wait(self):
+        self.__queue.join()
+        self._check()
+
+    def close(self):
+        self.wait()
+        self.__queue.put(None)
+        self.__thread.join()
@@ -1,51 +1,303 @@
+import copy
+import queue
+import threading
+import time
 import numpy as np
+from profiler import NullTimer
+from quantize import quantize_net
+from replay_buffer import states_to_tensor
+from checkpoint import rng_state, set_rng_state
+from metrics import TrainingMetrics
 
 
 class DQN:
-    def __init__(self, env, agent, initial_eps=1.0, min_eps=0.01, eps_decay=0.995, **kwargs):
+    def __init__(self, env, agent, initial_eps=1.0, min_eps=0.01, eps_decay=0.995, timer=None, checkpointer=None,
+                 checkpoint_every=0, recorder=None, metrics=None, **kwargs):
         self.__env = env
         self.__agent = agent
+        # optional PhaseTimer, shared with the agent so its phases are reported in the same per-episode line
+        self.__timer = NullTimer() if timer is None else timer
+        if timer is not None:
+            agent.timer = timer
         self.__eps = self.__eps_init = initial_eps
         self.__min_eps = min_eps
         self.__eps_decay = eps_decay
+        # optional CheckpointWriter, handed the full training state every checkpoint_every episodes
+        self.__checkpointer = checkpointer
+        self.__checkpoint_every = checkpoint_every
+        # optional TrajectoryWriter that every observed transition is streamed into
+        self.__recorder = recorder
+        # rolling aggregates of the finished episodes, streamed to a log if the TrainingMetrics has one
+        self.__metrics = TrainingMetrics() if metrics is None else metrics
+        # finished episodes and env steps so far, restored by load_state_dict when training resumes
+        self.__episode = 0
+        self.__env_steps = 0
+        self.__scores = []
+        self.__losses = []
+
+    def state_dict(self):
+        return {'episode': self.__episode,
+                'env_steps': self.__env_steps,
+                'eps': self.__eps,
+                'scores': list(self.__scores),
+                'losses': list(self.__losses),
+                'metrics': self.__metrics.state_dict(),
+                'agent': self.__agent.state_dict(),
+                'rng': rng_state()}
+
+    def load_state_dict(self, state):
+        self.__episode = state['episode']
+        self.__env_steps = state['env_steps']
+        self.__eps = state['eps']
+        self.__scores = list(state['scores'])
+        self.__losses = list(state['losses'])
+        self.__metrics.load_state_dict(state['metrics'])
+        self.__agent.load_state_dict(state['agent'])
+        set_rng_state(state['rng'])
+
+    def _record_episode(self, i, score, loss):
+        # called with the exploration rate and learning rate the episode was played with
+        self.__scores.append(score)
+        self.__losses.append(loss)
+        return self.__metrics.episode(i, score, loss, self.__eps, self.__agent.optimizer.param_groups[0]['lr'],
+                                      self.__env_steps)
+
+    def _end_episode(self, i):
+        self.__episode = i
+        if self.__checkpointer is not None and self.__checkpoint_every > 0 and i % self.__checkpoint_every == 0:
+            with self.__timer.phase('checkpoint'):
+                self.__checkpointer.save(self.state_dict(), i)
 
     def train(self, num_episodes, target_score=18.0, verbose=1):
+        if hasattr(self.__env, 'num_envs'):
+            return self._train_vectorized(num_episodes, target_score, verbose)
         solved = False
-        scores = []
-        losses = []
-        for i in range(1, num_episodes + 1):
+        scores = self.__scores
+        losses = self.__losses
+        for i in range(self.__episode + 1, num_episodes + 1):
             state = self.__env.reset()
             done = False
             score = 0
             loss = 0
             while not done:
-                action = self.__agent.act(state, self.__eps)  # choose action
-                next_state, reward, done = self.__env.step(action)  # roll out transition
+                with self.__timer.phase('act'):
+                    action = self.__agent.act(state, self.__eps)  # choose action
+                with self.__timer.phase('env.step'):
+                    next_state, reward, done = self.__env.step(action)  # roll out transition
+                if self.__recorder is not None:
+                    self.__recorder.add(state, action, reward, next_state, done)
                 loss += self.__agent.step(state, action, reward, next_state, done)  # agent's update routine
                 score += reward
                 state = next_state
+                self.__env_steps += 1
+            record = self._record_episode(i, score, loss)  # track scores and losses
             self.__eps = 1 / i
             # self.__eps = max(self.__min_eps, self.__eps * self.__eps_decay)  # decay epsilon
-            scores.append(score)  # track scores
-            losses.append(loss)  # track losses
-
-            avg_score = np.mean(scores[max(len(scores) - 100, 0):])
-            avg_loss = np.mean(losses[max(len(losses) - 100, 0):])
+            avg_score, avg_loss = record['avg_score'], record['avg_loss']
 
             if i % 100 == 0:
                 self.__agent.decay_learning_rate(0.8)
+            self._end_episode(i)
+            timing = self._timing()
 
             if not solved and avg_score > target_score:
                 solved = True
                 print('\n\n----------Env solved: score = {} | num_episodes = {}| -------------\n\n'.format(avg_score, i - 100))
                 return scores, losses
             if verbose:  # print routine
-                print("\r|progress: {:.1f}%| episode: {}| score: {}| avg score: {:.2f}| loss: {:.2f}| avg_loss: {:.2f}\n"
-                      .format(i * 100 / num_episodes, i, score, avg_score, loss, avg_loss), end='')
+                print("\r|progress: {:.1f}%| episode: {}| score: {}| avg score: {:.2f}| loss: {:.2f}| avg_loss: {:.2f}| steps/s: {:.0f}{}\n"
+                      .format(i * 100 / num_episodes, i, score, avg_score, loss, avg_loss, record['steps_per_sec'],
+                              timing), end='')
                 if i % 100 == 0:
                     print()
             i += 1
         return scores, losses
 
+    def _timing(self):
+        # per-episode phase times; also folds them into the run totals, so call it once per episode
+        report = self.__timer.episode_report()
+        return '| ' + report if report else ''
+
+    def _train_vectorized(self, num_episodes, target_score=18.0, verbose=1):
+        # same routine as train() for a VectorBananaEnvironment: all sub-environments are stepped together and an
+        # episode is counted whenever any of them finishes one
+        solved = False
+        scores = self.__scores
+        losses = self.__losses
+        env_losses = np.zeros(self.__env.num_envs)
+        states = self.__env.reset()
+        i = self.__episode
+        while i < num_episodes:
+            with self.__timer.phase('act'):
+                actions = self.__agent.act_batch(states, self.__eps)
+            with self.__timer.phase('env.step'):
+                next_states, rewards, dones = self.__env.step(actions)
+            if self.__recorder is not None:
+                self.__recorder.add_batch(states, actions, rewards, next_states, dones,
+                                          env_ids=np.arange(self.__env.num_envs))
+            for j in range(self.__env.num_envs):
+                env_losses[j] += self.__agent.step(states[j:j + 1], actions[j], rewards[j], next_states[j:j + 1],
+                                                   dones[j], env_id=j)
+            states = next_states
+            self.__env_steps += self.__env.num_envs
+
+            for j, score in self.__env.pop_finished_episodes():
+                if i == num_episodes:
+                    # several environments can finish on the last step; episodes past num_episodes are dropped
+                    break
+                i += 1
+                record = self._record_episode(i, score, env_losses[j])
+                self.__eps = 1 / i
+                env_losses[j] = 0
+                avg_score, avg_loss = record['avg_score'], record['avg_loss']
+
+                if i % 100 == 0:
+                    self.__agent.decay_learning_rate(0.8)
+                self._end_episode(i)
+                timing = self._timing()
+
+                if not solved and avg_score > target_score:
+                    solved = True
+                    print('\n\n----------Env solved: score = {} | num_episodes = {}| -------------\n\n'.format(avg_score, i - 100))
+                    return scores, losses
+                if verbose:  # print routine
+                    print("\r|progress: {:.1f}%| episode: {}| score: {}| avg score: {:.2f}| loss: {:.2f}| avg_loss: {:.2f}| steps/s: {:.0f}{}\n"
+                          .format(i * 100 / num_episodes, i, score, avg_score, losses[-1], avg_loss,
+                                  record['steps_per_sec'], timing), end='')
+                    if i % 100 == 0:
+                        print()
+        return scores, losses
 
 
+class AsyncDQN:
+    # Actor/learner split of DQN.train: num_actors threads, each with its own environment from env_fn(actor_id)
+    # and its own copy of the online network (re-synced every sync_every env steps), feed the agent's replay buffer,
+    # while the calling thread keeps learning from it at replay_ratio gradient updates per env step. Actors pause
+    # whenever the learner falls more than max_update_lag updates behind that ratio. With quantize_actors set to
+    # 'dynamic' or 'static', actors act on the CPU with an int8 copy of their network, re-quantized at every sync;
+    # static quantization calibrates on calibration_size states from the replay buffer.
+    def __init__(self, env_fn, agent, num_actors=2, replay_ratio=0.25, sync_every=100, max_update_lag=50,
+                 initial_eps=1.0, quantize_actors=None, calibration_size=16, metrics=None, **kwargs):
+        self.__env_fn = env_fn
+        self.__agent = agent
+        self.__num_actors = num_actors
+        self.__replay_ratio = replay_ratio
+        self.__sync_every = sync_every
+        self.__max_update_lag = max_update_lag
+        self.__eps = initial_eps
+        self.__quantize_actors = quantize_actors
+        self.__calibration_size = calibration_size
+        self.__metrics = TrainingMetrics() if metrics is None else metrics
+        self.__net_lock = threading.Lock()
+        self.__counter_lock = threading.Lock()
+        self.__env_steps = 0
+        self.__updates = 0
+        self.__finished = queue.Queue()
+        self.__stop = threading.Event()
+        self.__errors = []
+
+    def _actor(self, actor_id, net):
+        try:
+            env = self.__env_fn(actor_id)
+            try:
+                state = env.reset()
+                score = 0
+                steps = 0
+                while not self.__stop.is_set():
+                    if self._learner_lag() > self.__max_update_lag:
+                        time.sleep(1e-3)
+                        continue
+                    if steps % self.__sync_every == 0:
+                        with self.__net_lock:
+                            net.load_state_dict(self.__agent.net.state_dict())
+                        act_net, device = self._actor_net(net)
+                    action = self.__agent.act(state, self.__eps, net=act_net, device=device)
+                    next_state, reward, done = env.step(action)
+                    self.__agent.remember(state, action, reward, next_state, done, env_id=actor_id)
+                    with self.__counter_lock:
+                        self.__env_steps += 1
+                    steps += 1
+                    score += reward
+                    state = next_state
+                    if done:
+                        self.__finished.put(score)
+                        score = 0
+                        state = env.reset()
+            finally:
+                env.close()
+        except Exception as e:
+            self.__errors.append(e)
+            self.__stop.set()
+
+    def _actor_net(self, net):
+        # the network an actor acts with until its next sync, and the device it runs on
+        if self.__quantize_actors is None:
+            return net, self.__agent.device
+        calibration_states = None
+        if self.__quantize_actors == 'static':
+            with self.__agent.memory_lock:
+                if self.__agent.memory.size() < self.__calibration_size:
+                    # nothing to calibrate on yet
+                    return net, self.__agent.device
+                calibration_states = self.__agent.memory.sample_states(self.__calibration_size)
+            calibration_states = states_to_tensor('cpu', calibration_states)
+        return quantize_net(net, self.__quantize_actors, calibration_states), 'cpu'
+
+    def _learner_lag(self):
+        if not self.__agent.can_learn():
+            return 0
+        return self.__env_steps * self.__replay_ratio - self.__updates
+
+    def train(self, num_episodes, target_score=18.0, verbose=1):
+        solved = False
+        scores = []
+        losses = []
+        loss = 0
+        actors = [threading.Thread(target=self._actor, args=(i, copy.deepcopy(self.__agent.net)), daemon=True)
+                  for i in range(self.__num_actors)]
+        for actor in actors:
+            actor.start()
+        try:
+            i = 0
+            while i < num_episodes and not self.__stop.is_set():
+                # learner: keep the number of gradient updates at replay_ratio times the number of env steps
+                if self._learner_lag() > 0:
+                    with self.__net_lock:
+                        loss += self.__agent.learn()
+                    self.__updates += 1
+                elif self.__finished.empty():
+                    time.sleep(1e-3)
+
+                while not self.__finished.empty() and i < num_episodes:
+                    score = self.__finished.get()
+                    i += 1
+                    scores.append(score)
+                    losses.append(loss)
+                    updates_per_step = self.__updates / max(self.__env_steps, 1)
+                    record = self.__metrics.episode(i, score, loss, self.__eps,
+                                                    self.__agent.optimizer.param_groups[0]['lr'], self.__env_steps,
+                                                    updates_per_step=updates_per_step)
+                    self.__eps = 1 / i
+                    loss = 0
+                    avg_score, avg_loss = record['avg_score'], record['avg_loss']
+
+                    if i % 100 == 0:
+                        self.__agent.decay_learning_rate(0.8)
+
+                    if not solved and avg_score > target_score:
+                        solved = True
+                        print('\n\n----------Env solved: score = {} | num_episodes = {}| -------------\n\n'.format(avg_score, i - 100))
+                        return scores, losses
+                    if verbose:  # print routine
+                        print("\r|progress: {:.1f}%| episode: {}| score: {}| avg score: {:.2f}| loss: {:.2f}| avg_loss: {:.2f}| steps/s: {:.0f}| updates/step: {:.2f}\n"
+                              .format(i * 100 / num_episodes, i, score, avg_score, losses[-1], avg_loss,
+                                      record['steps_per_sec'], updates_per_step), end='')
+                        if i % 100 == 0:
+                            print()
+        finally:
+            self.__stop.set()
+            for actor in actors:
+                actor.join()
+        if self.__errors:
+            raise self.__errors[0]
+        return scores, losses
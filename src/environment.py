@@ -1,9 +1,15 @@
-from unityagents import UnityEnvironment
+import multiprocessing as mp
 import numpy as np
+try:
+    from unityagents import UnityEnvironment
+except ImportError:  # the simulated environments below do not need Unity
+    UnityEnvironment = None
 
 class BananaEnvironment:
-    def __init__(self, file_name=None, **kwargs):
-        self.__env = UnityEnvironment(file_name=file_name, seed=1234)  # create environment
+    def __init__(self, file_name=None, worker_id=0, **kwargs):
+        if UnityEnvironment is None:
+            raise ImportError('unityagents is required for the Unity Banana environments')
+        self.__env = UnityEnvironment(file_name=file_name, seed=1234 + worker_id, worker_id=worker_id)  # create environment
         self.__brain_name = self.__env.brain_names[0]
         self.__env.reset()
         self.__state_dim = self.__env.brains[self.__brain_name].vector_observation_space_size
@@ -32,29 +38,303 @@ class BananaEnvironment:
 
 
 class VisualBananaEnvironment:
-    def __init__(self, file_name=None, num_stacked_frames=4, **kwargs):
-        self.__env = UnityEnvironment(file_name=file_name, seed=1234)  # create environment
+    def __init__(self, file_name=None, num_stacked_frames=4, dtype=np.float32, worker_id=0, **kwargs):
+        if UnityEnvironment is None:
+            raise ImportError('unityagents is required for the Unity Banana environments')
+        self.__env = UnityEnvironment(file_name=file_name, seed=1234 + worker_id, worker_id=worker_id)  # create environment
         self.__brain_name = self.__env.brain_names[0]
         self.__num_stacked_frames = num_stacked_frames
+        self.__dtype = np.dtype(dtype)
+        # Circular frame stack: frame slots are written at decreasing positions modulo the period, and the first
+        # num_stacked_frames - 1 slots are mirrored at the end, so the newest-first stack is always the contiguous
+        # window [head, head + num_stacked_frames) and is handed out as a view. The state returned by the previous
+        # call stays intact for one more step or reset (the training loop keeps state and next_state alive together),
+        # it is overwritten by the call after that: steps write the slot just before the window, and a reset starts
+        # the new episode's stack in the slots that the window does not cover, which takes a period of twice the
+        # stack.
+        self.__period = 2 * num_stacked_frames
+        self.__frames = None
+        self.__head = 0
         self.reset()
-        self.__state_dim = np.array(self.__cur_state.shape)
+        self.__state_dim = np.array(self._state().shape)
         self.__action_dim = self.__env.brains[self.__brain_name].vector_action_space_size
 
+    def _to_frame(self, visual_observation):
+        frame = visual_observation[0].transpose((3, 0, 1, 2))[:, 0]  # (C, H, W)
+        if self.__dtype == np.uint8:
+            frame = np.rint(frame * 255.)
+        return frame
+
+    def _write(self, slot, frame):
+        self.__frames[0, :, slot] = frame
+        if slot < self.__num_stacked_frames - 1:
+            self.__frames[0, :, slot + self.__period] = frame
+
+    def _push(self, frame):
+        self.__head = (self.__head - 1) % self.__period
+        self._write(self.__head, frame)
+
+    def _state(self):
+        return self.__frames[:, :, self.__head:self.__head + self.__num_stacked_frames]
+
     def step(self, action):
         env_info = self.__env.step(action)[self.__brain_name]  # step
-        next_obs = env_info.visual_observations[0].transpose((3, 0, 1, 2))  # get the next state
-        self.__cur_state = np.roll(self.__cur_state, 1, axis=2)
-        self.__cur_state[0, :, 0, :, :] = next_obs.squeeze()
+        self._push(self._to_frame(env_info.visual_observations))  # get the next state
         reward = env_info.rewards[0]  # get the reward
         done = env_info.local_done[0]  # see if episode has finished
-        return self.__cur_state, reward, done
+        return self._state(), reward, done
 
     def reset(self, train_mode=True):
         env_info = self.__env.reset(train_mode=train_mode)[self.__brain_name]
-        obs = env_info.visual_observations[0].transpose((3, 0, 1, 2))
-        self.__cur_state = np.zeros((1, obs.shape[0], self.__num_stacked_frames, obs.shape[2], obs.shape[3]))
-        self.__cur_state[0, :, 0, :, :] = obs.squeeze()
-        return self.__cur_state
+        frame = self._to_frame(env_info.visual_observations)
+        if self.__frames is None:
+            self.__frames = np.zeros((1, frame.shape[0], self.__period + self.__num_stacked_frames - 1) +
+                                     frame.shape[1:], dtype=self.__dtype)
+        else:
+            # the new stack takes the num_stacked_frames slots before the last returned one, frames before the
+            # episode start are zero
+            self.__head = (self.__head - self.__num_stacked_frames) % self.__period
+            for i in range(1, self.__num_stacked_frames):
+                self._write((self.__head + i) % self.__period, 0)
+            self.__head = (self.__head + 1) % self.__period
+        self._push(frame)
+        return self._state()
+
+    def get_state_dim(self):
+        return self.__state_dim
+
+    def get_action_dim(self):
+        return self.__action_dim
+
+    def close(self):
+        self.__env.close()
+
+
+def _env_worker(conn, env_cls, env_kwargs):
+    env = env_cls(**env_kwargs)
+    try:
+        while True:
+            cmd, data = conn.recv()
+            if cmd == 'step':
+                next_state, reward, done = env.step(data)
+                if done:
+                    # the episode is over, continue with a fresh one; the terminal state is masked out of the
+                    # bootstrap target by done anyway
+                    next_state = env.reset()
+                conn.send((np.array(next_state), reward, done))
+            elif cmd == 'reset':
+                conn.send(np.array(env.reset(train_mode=data)))
+            elif cmd == 'dims':
+                conn.send((env.get_state_dim(), env.get_action_dim()))
+            elif cmd == 'close':
+                break
+    finally:
+        env.close()
+        conn.close()
+
+
+class VectorBananaEnvironment:
+    # Runs num_envs copies of env_cls in subprocesses (each on its own Unity worker port) and steps them in lockstep.
+    # States, rewards and dones are stacked along the first axis; finished sub-episodes are reset automatically.
+    def __init__(self, env_cls=BananaEnvironment, num_envs=2, worker_id=0, **kwargs):
+        self.num_envs = num_envs
+        self.__conns = []
+        self.__procs = []
+        for i in range(num_envs):
+            parent_conn, child_conn = mp.Pipe()
+            env_kwargs = dict(kwargs, worker_id=worker_id + i)
+            proc = mp.Process(target=_env_worker, args=(child_conn, env_cls, env_kwargs), daemon=True)
+            proc.start()
+            child_conn.close()
+            self.__conns.append(parent_conn)
+            self.__procs.append(proc)
+        self.__conns[0].send(('dims', None))
+        self.__state_dim, self.__action_dim = self.__conns[0].recv()
+        self.__scores = np.zeros(num_envs)
+        self.__finished_scores = []
+
+    def step(self, actions):
+        for conn, action in zip(self.__conns, actions):
+            conn.send(('step', int(action)))
+        next_states, rewards, dones = zip(*[conn.recv() for conn in self.__conns])
+        rewards = np.array(rewards, dtype=np.float64)
+        dones = np.array(dones, dtype=bool)
+        self.__scores += rewards
+        for i in np.flatnonzero(dones):
+            self.__finished_scores.append((i, self.__scores[i]))
+            self.__scores[i] = 0
+        return np.concatenate(next_states), rewards, dones
+
+    def reset(self, train_mode=True):
+        for conn in self.__conns:
+            conn.send(('reset', train_mode))
+        self.__scores[:] = 0
+        self.__finished_scores = []
+        return np.concatenate([conn.recv() for conn in self.__conns])
+
+    def pop_finished_episodes(self):
+        # (env index, score) of every sub-episode finished since the last call
+        finished, self.__finished_scores = self.__finished_scores, []
+        return finished
+
+    def get_state_dim(self):
+        return self.__state_dim
+
+    def get_action_dim(self):
+        return self.__action_dim
+
+    def close(self):
+        for conn in self.__conns:
+            conn.send(('close', None))
+        for proc in self.__procs:
+            proc.join()
+
+
+class BatchedSimBananaEnvironment:
+    # Pure NumPy stand-in for the Banana environments, stepping num_envs independent worlds at once.
+    # The agent walks in a square arena with yellow (+1) and blue (-1) bananas that respawn when collected.
+    # Vector observations mimic Unity's 37-dim ray perception: 7 rays x (yellow, wall, blue, agent, distance)
+    # plus forward and angular velocity. Visual observations are a crude first-person 84x84 RGB rendering,
+    # stacked like VisualBananaEnvironment does. The API follows VectorBananaEnvironment.
+    ray_angles = np.deg2rad([-70., -45., -20., 0., 20., 45., 70.])
+
+    def __init__(self, num_envs=1024, visual=False, num_stacked_frames=4, dtype=np.float32, seed=0,
+                 episode_length=300, num_bananas=30, yellow_fraction=0.6, arena_size=10., auto_reset=True,
+                 worker_id=0, **kwargs):
+        self.num_envs = num_envs
+        self.__visual = visual
+        self.__num_stacked_frames = num_stacked_frames
+        self.__dtype = np.dtype(dtype)
+        self.__rng = np.random.RandomState(seed + worker_id)
+        self.__episode_length = episode_length
+        self.__num_bananas = num_bananas
+        self.__yellow_fraction = yellow_fraction
+        self.__half_size = arena_size
+        self.__ray_length = 1.5 * arena_size
+        self.__auto_reset = auto_reset
+        self.__speed = 0.3
+        self.__turn_rate = np.deg2rad(10.)
+        self.__banana_radius = 0.5
+        self.__image_size = 84
+
+        self.__pos = np.zeros((num_envs, 2))
+        self.__heading = np.zeros(num_envs)
+        self.__vel = np.zeros(num_envs)
+        self.__ang_vel = np.zeros(num_envs)
+        self.__bananas = np.zeros((num_envs, num_bananas, 2))
+        self.__yellow = np.zeros((num_envs, num_bananas), dtype=bool)
+        self.__t = np.zeros(num_envs, dtype=np.int64)
+        self.__scores = np.zeros(num_envs)
+        self.__finished_scores = []
+        if visual:
+            self.__stacks = np.zeros((num_envs, 3, num_stacked_frames, self.__image_size, self.__image_size),
+                                     dtype=self.__dtype)
+            self.__state_dim = np.array((1,) + self.__stacks.shape[1:])
+        else:
+            self.__state_dim = 37
+        self.__action_dim = 4
+        self.reset()
+
+    def _respawn(self, mask):
+        n = np.count_nonzero(mask)
+        self.__bananas[mask] = self.__rng.uniform(-self.__half_size, self.__half_size, (n, 2))
+        self.__yellow[mask] = self.__rng.uniform(size=n) < self.__yellow_fraction
+
+    def _reset_envs(self, envs):
+        n = len(envs)
+        self.__pos[envs] = self.__rng.uniform(-0.5 * self.__half_size, 0.5 * self.__half_size, (n, 2))
+        self.__heading[envs] = self.__rng.uniform(-np.pi, np.pi, n)
+        self.__vel[envs] = 0
+        self.__ang_vel[envs] = 0
+        self.__t[envs] = 0
+        self.__scores[envs] = 0
+        mask = np.zeros((self.num_envs, self.__num_bananas), dtype=bool)
+        mask[envs] = True
+        self._respawn(mask)
+        if self.__visual:
+            self.__stacks[envs] = 0
+
+    def _cast(self, angles):
+        # nearest hit along rays at the given absolute angles (num_envs, num_rays):
+        # kind 0 - yellow banana, 1 - wall, 2 - blue banana; distance is in arena units
+        dirs = np.stack((np.cos(angles), np.sin(angles)), axis=-1)
+        rel = self.__bananas - self.__pos[:, np.newaxis]
+        along = np.einsum('nrd,nbd->nrb', dirs, rel)
+        across = dirs[..., 0:1] * rel[:, np.newaxis, :, 1] - dirs[..., 1:2] * rel[:, np.newaxis, :, 0]
+        along = np.where((along > 0) & (np.abs(across) < self.__banana_radius), along, np.inf)
+        nearest = np.argmin(along, axis=2)
+        banana_dist = np.take_along_axis(along, nearest[..., np.newaxis], axis=2)[..., 0]
+        banana_yellow = np.take_along_axis(self.__yellow, nearest, axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bound = np.where(dirs > 0, self.__half_size, -self.__half_size)
+            wall_dist = np.where(dirs != 0, (bound - self.__pos[:, np.newaxis]) / dirs, np.inf).min(axis=2)
+        kind = np.where(banana_dist < wall_dist, np.where(banana_yellow, 0, 2), 1)
+        return kind, np.minimum(banana_dist, wall_dist)
+
+    def _vector_obs(self):
+        kind, dist = self._cast(self.__heading[:, np.newaxis] + self.ray_angles)
+        hit = dist < self.__ray_length
+        rays = np.zeros(kind.shape + (5,))
+        rays[..., :3] = (kind[..., np.newaxis] == np.arange(3)) & hit[..., np.newaxis]
+        rays[..., 4] = np.minimum(dist / self.__ray_length, 1.)
+        return np.concatenate((rays.reshape(self.num_envs, -1),
+                               self.__vel[:, np.newaxis], self.__ang_vel[:, np.newaxis]), axis=1)
+
+    def _render(self):
+        size = self.__image_size
+        columns = np.linspace(np.pi / 4, -np.pi / 4, size)  # 90 degrees field of view, left to right
+        kind, dist = self._cast(self.__heading[:, np.newaxis] + columns)
+        colors = np.array([[1., 1., 0.], [.6, .6, .6], [0., 0., 1.]])[kind]  # (num_envs, size, 3)
+        colors *= 1. / (1. + 0.05 * dist[..., np.newaxis])
+        half_height = np.where(kind == 1, 1.5, 0.5) * size / (np.maximum(dist, 1e-3) + 1.)
+        rows = np.abs(np.arange(size) - (size - 1) / 2.)
+        mask = rows[np.newaxis, :, np.newaxis] < half_height[:, np.newaxis, :]  # (num_envs, rows, columns)
+        background = np.where(np.arange(size) < size / 2, 0.8, 0.3)[:, np.newaxis]  # sky and floor
+        frame = np.where(mask[:, np.newaxis], colors.transpose((0, 2, 1))[:, :, np.newaxis, :],
+                         background[np.newaxis, np.newaxis])
+        if self.__dtype == np.uint8:
+            frame = np.rint(frame * 255.)
+        return frame
+
+    def _observe(self):
+        if not self.__visual:
+            return self._vector_obs().astype(self.__dtype, copy=False)
+        self.__stacks[:, :, 1:] = self.__stacks[:, :, :-1].copy()
+        self.__stacks[:, :, 0] = self._render()
+        return self.__stacks.copy()
+
+    def step(self, actions):
+        actions = np.asarray(actions).reshape(self.num_envs)
+        self.__vel = 0.5 * self.__vel + 0.5 * self.__speed * ((actions == 0).astype(float) - (actions == 1))
+        self.__ang_vel = self.__turn_rate * ((actions == 2).astype(float) - (actions == 3))
+        self.__heading += self.__ang_vel
+        direction = np.stack((np.cos(self.__heading), np.sin(self.__heading)), axis=1)
+        limit = self.__half_size - self.__banana_radius
+        self.__pos = np.clip(self.__pos + self.__vel[:, np.newaxis] * direction, -limit, limit)
+
+        collected = ((self.__bananas - self.__pos[:, np.newaxis]) ** 2).sum(axis=2) < self.__banana_radius ** 2
+        rewards = (collected & self.__yellow).sum(axis=1) - (collected & ~self.__yellow).sum(axis=1)
+        rewards = rewards.astype(np.float64)
+        self._respawn(collected)
+
+        self.__t += 1
+        self.__scores += rewards
+        dones = self.__t >= self.__episode_length
+        finished = np.flatnonzero(dones)
+        self.__finished_scores.extend((i, self.__scores[i]) for i in finished)
+        if self.__auto_reset and len(finished):
+            self._reset_envs(finished)
+        return self._observe(), rewards, dones
+
+    def reset(self, train_mode=True):
+        self._reset_envs(np.arange(self.num_envs))
+        self.__finished_scores = []
+        return self._observe()
+
+    def pop_finished_episodes(self):
+        finished, self.__finished_scores = self.__finished_scores, []
+        return finished
 
     def get_state_dim(self):
         return self.__state_dim
@@ -62,5 +342,27 @@ class VisualBananaEnvironment:
     def get_action_dim(self):
         return self.__action_dim
 
+    def close(self):
+        pass
+
+
+class SimBananaEnvironment:
+    # Single-environment drop-in for BananaEnvironment (visual=False) or VisualBananaEnvironment (visual=True)
+    def __init__(self, visual=False, **kwargs):
+        self.__env = BatchedSimBananaEnvironment(num_envs=1, visual=visual, auto_reset=False, **kwargs)
+
+    def step(self, action):
+        next_state, reward, done = self.__env.step([action])
+        return next_state, reward[0], done[0]
+
+    def reset(self, train_mode=True):
+        return self.__env.reset(train_mode)
+
+    def get_state_dim(self):
+        return self.__env.get_state_dim()
+
+    def get_action_dim(self):
+        return self.__env.get_action_dim()
+
     def close(self):
         self.__env.close()
@@ -0,0 +1,114 @@
+from environment import VisualBananaEnvironment, BananaEnvironment, VectorBananaEnvironment, \
+    BatchedSimBananaEnvironment
+from neural_net import ConvQNetwork
+from replay_buffer import states_to_tensor
+import argparse
+import glob
+import json
+import time
+import numpy as np
+import torch
+
+
+def load_net(fname, device):
+    # the online network of an agent saved by DQNAgentBase.save, ready for inference
+    ckpt = torch.load(fname, map_location=device, weights_only=False)
+    return ckpt['net'].to(device).eval()
+
+
+def make_eval_env(visual, **kwargs):
+    # every evaluation environment is vectorized, so all running episodes share one forward pass per step
+    if kwargs['simulated']:
+        return BatchedSimBananaEnvironment(num_envs=kwargs['num_envs'], visual=visual,
+                                           num_stacked_frames=kwargs['num_stacked_frames'],
+                                           dtype=kwargs['frame_dtype'], seed=kwargs['seed'],
+                                           worker_id=kwargs['worker_id'])
+    if visual:
+        return VectorBananaEnvironment(env_cls=VisualBananaEnvironment, num_envs=kwargs['num_envs'],
+                                       worker_id=kwargs['worker_id'], file_name=kwargs['visual_env_file'],
+                                       num_stacked_frames=kwargs['num_stacked_frames'], dtype=kwargs['frame_dtype'])
+    return VectorBananaEnvironment(env_cls=BananaEnvironment, num_envs=kwargs['num_envs'],
+                                   worker_id=kwargs['worker_id'], file_name=kwargs['env_file'])
+
+
+def run_episodes(net, env, num_episodes, device):
+    # greedy rollouts of net until num_episodes episodes have finished; episodes still running then are dropped
+    scores = []
+    states = env.reset()
+    env.pop_finished_episodes()
+    with torch.no_grad():
+        while len(scores) < num_episodes:
+            actions = net(states_to_tensor(device, states)).argmax(1).cpu().numpy()
+            states, _, _ = env.step(actions)
+            scores.extend(score for _, score in env.pop_finished_episodes())
+    return np.array(scores[:num_episodes])
+
+
+def score_stats(scores, elapsed):
+    p5, p25, p50, p75, p95 = np.percentile(scores, [5, 25, 50, 75, 95])
+    return {'episodes': len(scores), 'mean': float(np.mean(scores)), 'std': float(np.std(scores)),
+            'min': float(np.min(scores)), 'max': float(np.max(scores)),
+            'p5': p5, 'p25': p25, 'p50': p50, 'p75': p75, 'p95': p95,
+            'episodes_per_sec': len(scores) / elapsed}
+
+
+def evaluate(**kwargs):
+    device = "cuda:0" if torch.cuda.is_available() and kwargs['use_gpu'] else "cpu"
+    fnames = sorted(set(fname for pattern in kwargs['checkpoints'] for fname in glob.glob(pattern)))
+    # Unity workers are started once per environment type and reused by every checkpoint; simulated environments
+    # are rebuilt per checkpoint so that all of them are scored on the same seeded episodes
+    envs = {}
+    results = []
+    try:
+        for fname in fnames:
+            net = load_net(fname, device)
+            visual = isinstance(net, ConvQNetwork)
+            if kwargs['simulated'] or visual not in envs:
+                if visual in envs:
+                    envs[visual].close()
+                envs[visual] = make_eval_env(visual, **kwargs)
+            start = time.perf_counter()
+            scores = run_episodes(net, envs[visual], kwargs['num_episodes'], device)
+            result = dict(checkpoint=fname, env_type='visual' if visual else 'simple',
+                          **score_stats(scores, time.perf_counter() - start))
+            results.append(result)
+            print('{}: mean {:.2f} +- {:.2f} | p50 {:.1f} | {:.1f} episodes/s'.format(
+                fname, result['mean'], result['std'], result['p50'], result['episodes_per_sec']))
+    finally:
+        for env in envs.values():
+            env.close()
+
+    results.sort(key=lambda r: r['mean'], reverse=True)
+    with open(kwargs['output'], 'w') as f:
+        json.dump({'num_episodes': kwargs['num_episodes'], 'results': results}, f, indent=1)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('checkpoints', type=str, nargs='+',
+                        help='saved agents (.pt) or glob patterns of them')
+    parser.add_argument('--env_file', type=str, default='../Banana_env/Banana.exe',
+                        help='file path of the simple Unity environment')
+    parser.add_argument('--visual_env_file', type=str, default='../VisualBanana_env/Banana.exe',
+                        help='file path of the visual Unity environment')
+    parser.add_argument('--simulated', action='store_true',
+                        help='evaluate in the NumPy simulated banana environment instead of Unity')
+    parser.add_argument('--num_envs', type=int, default=8,
+                        help='environment workers the episodes are spread across')
+    parser.add_argument('--num_episodes', type=int, default=100,
+                        help='evaluation episodes per checkpoint')
+    parser.add_argument('--num_stacked_frames', type=int, default=4,
+                        help='number of frames to stack for state representation')
+    parser.add_argument('--frame_dtype', type=str, default='float32', choices=['uint8', 'float32', 'float64'],
+                        help='dtype of the stacked frames returned by the visual environment')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the simulated environment')
+    parser.add_argument('--worker_id', type=int, default=0,
+                        help='first Unity worker port offset')
+    parser.add_argument('--use_gpu', type=bool, default=True,
+                        help='whether use gpu or not')
+    parser.add_argument('--output', type=str, default='evaluation.json',
+                        help='file to write the JSON results to')
+    args = parser.parse_args()
+    evaluate(**vars(args))
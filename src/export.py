@@ -0,0 +1,98 @@
+from neural_net import ConvQNetwork
+from profiler import measure
+import argparse
+import json
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class GreedyPolicy(nn.Module):
+    # the Q-network followed by the greedy action choice, so one call of the exported graph returns actions
+    def __init__(self, net):
+        super(GreedyPolicy, self).__init__()
+        self.net = net
+
+    def forward(self, x):
+        return self.net(x).argmax(1)
+
+
+def export_policy(net, fname, state_shape):
+    # Traces net in eval mode (BatchNorm uses its running statistics, dropout is off) into a frozen TorchScript
+    # module saved at fname. state_shape is the shape of one observation without the batch axis; it is stored
+    # next to the graph so the runner can preallocate its input.
+    policy = GreedyPolicy(net.to('cpu')).eval()
+    example = torch.rand((1,) + tuple(state_shape))
+    with torch.no_grad():
+        module = torch.jit.freeze(torch.jit.trace(policy, example))
+    meta = {'state_shape': list(state_shape), 'visual': isinstance(net, ConvQNetwork),
+            'num_actions': int(net(example).shape[1])}
+    torch.jit.save(module, fname, _extra_files={'policy.json': json.dumps(meta)})
+    return meta
+
+
+def export_agent(agent_fname, fname):
+    # exports the online network of an agent saved by DQNAgentBase.save
+    net = torch.load(agent_fname, map_location='cpu', weights_only=False)['net']
+    # ConvQNetwork is built from the full (1, C, F, H, W) observation shape, MlpQNetwork from the state size
+    state_shape = net.get_state_dim()[1:] if isinstance(net, ConvQNetwork) else (net.get_state_dim(),)
+    return export_policy(net, fname, state_shape)
+
+
+class PolicyRunner:
+    # Greedy actions from an exported policy without the training stack: no agent, target network, optimizer or
+    # replay buffer. Observations are copied into a preallocated input tensor, uint8 frames are scaled to [0, 1].
+    def __init__(self, fname, num_threads=None):
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        extra_files = {'policy.json': ''}
+        self.__module = torch.jit.load(fname, map_location='cpu', _extra_files=extra_files)
+        self.meta = json.loads(extra_files['policy.json'])
+        self.__input = torch.zeros([1] + self.meta['state_shape'])
+
+    def act(self, state):
+        state = np.asarray(state)
+        self.__input.copy_(torch.from_numpy(state).view(self.__input.shape))
+        if state.dtype == np.uint8:
+            self.__input.div_(255.)
+        with torch.inference_mode():
+            return int(self.__module(self.__input)[0])
+
+    def act_batch(self, states):
+        states = np.asarray(states)
+        x = torch.from_numpy(states).float().view([-1] + self.meta['state_shape'])
+        if states.dtype == np.uint8:
+            x.div_(255.)
+        with torch.inference_mode():
+            return self.__module(x).numpy()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('agent_fname', type=str,
+                        help='agent saved by train.py')
+    parser.add_argument('policy_fname', type=str,
+                        help='file to write the exported policy to')
+    parser.add_argument('--num_iters', type=int, default=1000,
+                        help='timed greedy actions of the exported policy')
+    parser.add_argument('--num_threads', type=int, default=1,
+                        help='torch intra-op threads of the policy runner')
+    args = parser.parse_args()
+
+    meta = export_agent(args.agent_fname, args.policy_fname)
+    start = time.perf_counter()
+    runner = PolicyRunner(args.policy_fname, num_threads=args.num_threads)
+    load_sec = time.perf_counter() - start
+
+    # the exported graph has to pick the same actions as the network it was traced from
+    net = torch.load(args.agent_fname, map_location='cpu', weights_only=False)['net'].eval()
+    states = np.random.rand(*([256] + meta['state_shape'])).astype(np.float32)
+    with torch.no_grad():
+        expected = net(torch.from_numpy(states)).argmax(1).numpy()
+    agreement = np.mean(runner.act_batch(states) == expected)
+
+    state = states[:1]
+    latency = measure(lambda: runner.act(state), args.num_iters)
+    print('exported {} to {}: load {:.1f}ms | action agreement {:.3f} | act p50 {:.3f}ms p99 {:.3f}ms'.format(
+        args.agent_fname, args.policy_fname, 1e3 * load_sec, agreement, latency['p50_ms'], latency['p99_ms']))
@@ -0,0 +1,155 @@
+import json
+import queue
+import threading
+import time
+from collections import deque
+
+
+class RollingMean:
+    # mean of the last window values in O(1) per add: a ring of the values and their running sum, which is
+    # re-summed exactly once per lap of the ring so rounding errors cannot pile up over a long run
+    def __init__(self, window=100):
+        self.__window = window
+        self.__values = [0.] * window
+        self.__pos = 0
+        self.__count = 0
+        self.__sum = 0.
+
+    def add(self, value):
+        value = float(value)
+        self.__sum += value - self.__values[self.__pos]
+        self.__values[self.__pos] = value
+        self.__pos = (self.__pos + 1) % self.__window
+        self.__count = min(self.__count + 1, self.__window)
+        if self.__pos == 0:
+            self.__sum = sum(self.__values)
+
+    def mean(self):
+        return self.__sum / self.__count if self.__count else 0.
+
+    def state_dict(self):
+        return {'values': list(self.__values), 'pos': self.__pos, 'count': self.__count}
+
+    def load_state_dict(self, state):
+        self.__values = list(state['values'])
+        self.__pos = state['pos']
+        self.__count = state['count']
+        self.__sum = sum(self.__values)
+
+
+class RateMeter:
+    # events per second over the last window marks, from a ring of (time, running event count) pairs
+    def __init__(self, window=100):
+        self.__marks = deque(maxlen=window + 1)
+
+    def mark(self, count, now=None):
+        self.__marks.append((time.perf_counter() if now is None else now, count))
+
+    def rate(self):
+        if len(self.__marks) < 2:
+            return 0.
+        (t0, n0), (t1, n1) = self.__marks[0], self.__marks[-1]
+        return (n1 - n0) / (t1 - t0) if t1 > t0 else 0.
+
+
+class MetricsWriter:
+    # Appends records as JSON lines to fname from a background thread. Records are queued without blocking the
+    # caller; the thread writes whatever has queued up in one go and flushes, so the log can be followed
+    # (e.g. with tail -f or read_metrics) while the run is live.
+    def __init__(self, fname):
+        self.__file = open(fname, 'a')
+        self.__queue = queue.Queue()
+        self.__error = None
+        self.__thread = threading.Thread(target=self._run, daemon=True)
+        self.__thread.start()
+
+    def write(self, record):
+        if self.__error is not None:
+            raise self.__error
+        self.__queue.put(record)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            records = [self.__queue.get()]
+            while True:
+                try:
+                    records.append(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = records[-1] is None
+            records = [record for record in records if record is not None]
+            try:
+                if records:
+                    self.__file.write(''.join(json.dumps(record) + '\n' for record in records))
+                    self.__file.flush()
+            except Exception as e:
+                self.__error = e
+
+    def close(self):
+        # writes every queued record before returning
+        self.__queue.put(None)
+        self.__thread.join()
+        self.__file.close()
+        if self.__error is not None:
+            raise self.__error
+
+
+def read_metrics(fname):
+    # the records of a metrics log, skipping a last line that is still being written
+    records = []
+    with open(fname) as f:
+        for line in f:
+            if line.endswith('\n'):
+                records.append(json.loads(line))
+    return records
+
+
+class TrainingMetrics:
+    # Per-episode training metrics: rolling means over the last window episodes of score, loss, epsilon and
+    # learning rate, and env steps per second over the same episodes, all updated in O(1) per episode. With fname
+    # set, every episode record is also streamed to a JSON lines log by a MetricsWriter.
+    def __init__(self, fname=None, window=100):
+        self.__means = {name: RollingMean(window) for name in ('score', 'loss', 'eps', 'lr')}
+        # the rate is measured from the start of the run (or of the resumed part of it) until the window is full
+        self.__window = window
+        self.__steps = RateMeter(window)
+        self.__steps.mark(0)
+        self.__env_steps = 0
+        self.__start = time.time()
+        self.__writer = MetricsWriter(fname) if fname else None
+
+    def mean(self, name):
+        return self.__means[name].mean()
+
+    def episode(self, episode, score, loss, eps, lr, env_steps, **extra):
+        # records one finished episode and returns its record
+        values = {'score': score, 'loss': loss, 'eps': eps, 'lr': lr}
+        for name, value in values.items():
+            self.__means[name].add(value)
+        self.__steps.mark(env_steps)
+        self.__env_steps = env_steps
+        record = {'episode': episode, 'time': time.time() - self.__start, 'env_steps': int(env_steps)}
+        record.update((name, float(value)) for name, value in values.items())
+        record.update(('avg_' + name, mean.mean()) for name, mean in self.__means.items())
+        record['steps_per_sec'] = self.__steps.rate()
+        record.update(extra)
+        if self.__writer is not None:
+            self.__writer.write(record)
+        return record
+
+    def state_dict(self):
+        # steps per second are wall-clock rates and start over when a run resumes
+        return {'means': {name: mean.state_dict() for name, mean in self.__means.items()},
+                'env_steps': self.__env_steps}
+
+    def load_state_dict(self, state):
+        for name, mean in self.__means.items():
+            mean.load_state_dict(state['means'][name])
+        self.__env_steps = state['env_steps']
+        self.__steps = RateMeter(self.__window)
+        self.__steps.mark(self.__env_steps)
+
+    def close(self):
+        if self.__writer is not None:
+            self.__writer.close()
@@ -22,6 +22,9 @@ class MlpQNetwork(nn.Module):
         x = self.__fc4(x)
         return x
 
+    def get_state_dim(self):
+        return self.__state_dim
+
 
 class ConvQNetwork(nn.Module):
     def __init__(self, state_dim, num_actions):
@@ -56,7 +59,7 @@ class ConvQNetwork(nn.Module):
         x = F.relu(self.__bn2(self.__conv2(x)))
         x = F.relu(self.__bn3(self.__conv3(x)))
         x = F.relu(self.__bn4(self.__conv4(x)))
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
 
         x = F.relu(self.__fc1(x))
         x = self.__fc_out(x)
@@ -71,6 +74,9 @@ class ConvQNetwork(nn.Module):
         size = x.data.view(1, -1).size(1)
         return size
 
+    def get_state_dim(self):
+        return self.__state_dim
+
 
 #
 # class ConvQNetwork(nn.Module):
@@ -97,7 +103,7 @@ class ConvQNetwork(nn.Module):
 #         x = F.relu(self.__bn1(self.__conv1(x)))
 #         x = F.relu(self.__bn2(self.__conv2(x)))
 #         x = F.relu(self.__bn3(self.__conv3(x)))
-#         x = x.view(x.size(0), -1)
+#         x = x.reshape(x.size(0), -1)
 #
 #         x = F.relu(self.__fc1(x))
 #         x = self.__fc_out(x)
@@ -1,30 +1,44 @@
 from environment import VisualBananaEnvironment, BananaEnvironment
-from agent import DQNAgent, DDQNAgent, DQNAgentPER, DDQNAgentPER
+from export import PolicyRunner
 import argparse
 
 
 def play(**kwargs):
-    env = BananaEnvironment(file_name=kwargs['env_file'], num_stacked_frames=kwargs['num_stacked_frames'])
     agent_name = kwargs['agent_fname']
-    is_per = 'PER' in agent_name
-    if 'ddqn' in agent_name:
-        agent = DDQNAgentPER.load(agent_name) if is_per else DDQNAgent.load(agent_name)
-    elif 'dqn' in agent_name:
-        agent = DQNAgentPER.load(agent_name) if is_per else DQNAgent.load(agent_name)
+    if agent_name.endswith('.ts'):
+        # policy exported by export.py: greedy actions without the training stack
+        policy = PolicyRunner(agent_name)
+        act = policy.act
+        visual = policy.meta['visual']
     else:
-        raise KeyError('Unknown agent type')
+        # the training stack (agents, replay buffers) is only imported to unpickle a saved agent
+        from agent import DQNAgent, DDQNAgent, DQNAgentPER, DDQNAgentPER
+        from neural_net import ConvQNetwork
+        is_per = 'PER' in agent_name
+        if 'ddqn' in agent_name:
+            agent = DDQNAgentPER.load(agent_name) if is_per else DDQNAgent.load(agent_name)
+        elif 'dqn' in agent_name:
+            agent = DQNAgentPER.load(agent_name) if is_per else DQNAgent.load(agent_name)
+        else:
+            raise KeyError('Unknown agent type')
+        act = lambda state: agent.act(state, eps=0.)
+        visual = isinstance(agent.net, ConvQNetwork)
+    if visual:
+        env = VisualBananaEnvironment(file_name=kwargs['env_file'], num_stacked_frames=kwargs['num_stacked_frames'])
+    else:
+        env = BananaEnvironment(file_name=kwargs['env_file'])
 
     for i in range(kwargs['num_plays']):
         done = False
         score = 0
         state = env.reset(train_mode=False)
         while not done:
-            action = agent.act(state, eps=0.)
-            env.step(action)
+            action = act(state)
             state, reward, done = env.step(action)  # roll out transition
             score += reward
             print("\r play #{}, reward: {} | score: {}".format(i+1, reward, score), end='')
         print()
+    env.close()
 
 
 if __name__ == '__main__':
@@ -34,7 +48,7 @@ if __name__ == '__main__':
     parser.add_argument('--env_file', type=str,
                         help='file path of Unity environment')
     parser.add_argument('--agent_fname', type=str,
-                        help='file to load agent from')
+                        help='file to load agent from, or a policy (.ts) exported by export.py')
     parser.add_argument('--num_plays', type=int, default=4,
                         help='number of episodes to run agent')
     parser.add_argument('--num_stacked_frames', type=int, default=4,
@@ -0,0 +1,85 @@
+import queue
+import threading
+import numpy as np
+import torch
+
+
+class _StagingSlot:
+    # Preallocated tensors for one minibatch: host staging tensors (pinned when the device is a GPU) that the
+    # sampled NumPy columns are copied into, and device tensors in the dtypes the agents train with.
+    def __init__(self, device):
+        self.__device = torch.device(device)
+        self.__host = None
+        self.__dev = None
+
+    def _allocate(self, arrays):
+        if self.__device.type == 'cuda':
+            self.__host = [torch.empty(a.shape, dtype=torch.from_numpy(a[:0]).dtype, pin_memory=True)
+                           for a in arrays]
+        self.__dev = [torch.empty(a.shape, dtype=torch.long if a.dtype == np.int64 else torch.float32,
+                                  device=self.__device) for a in arrays]
+
+    def fill(self, arrays):
+        if self.__dev is None or any(d.shape != a.shape for d, a in zip(self.__dev, arrays)):
+            # the first prioritized minibatch can be larger than the others
+            self._allocate(arrays)
+        for i, (dev, array) in enumerate(zip(self.__dev, arrays)):
+            if self.__host is None:
+                # CPU training: copy straight into the reusable tensors
+                dev.copy_(torch.from_numpy(array))
+            else:
+                self.__host[i].copy_(torch.from_numpy(array))
+                dev.copy_(self.__host[i], non_blocking=True)
+            if array.dtype == np.uint8:
+                dev.div_(255.)  # frames are scaled back to [0, 1] as in states_to_tensor
+        return tuple(self.__dev)
+
+
+class MinibatchPrefetcher:
+    # Samples the next num_batches minibatches of memory on a background thread and stages them into reusable
+    # tensors, so gathering and host-to-device copies overlap with the running gradient step. A minibatch
+    # returned by next() stays valid until the following call. For prioritized buffers the sampled slot indices
+    # are returned as a NumPy array after the tensors, as PrioritizedReplayBuffer.sample does; priorities of a
+    # prefetched minibatch may be up to num_batches updates old.
+    def __init__(self, memory, device, lock=None, num_batches=2):
+        self.__memory = memory
+        self.__lock = threading.RLock() if lock is None else lock
+        self.__ready = queue.Queue()
+        self.__free = queue.Queue()
+        # num_batches waiting, one being filled and one held by the consumer
+        for _ in range(num_batches + 2):
+            self.__free.put(_StagingSlot(device))
+        self.__in_use = None
+        self.__stop = threading.Event()
+        self.__error = None
+        self.__thread = threading.Thread(target=self._run, daemon=True)
+        self.__thread.start()
+
+    def _run(self):
+        try:
+            while not self.__stop.is_set():
+                try:
+                    slot = self.__free.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                with self.__lock:
+                    arrays = self.__memory.sample_arrays()
+                # PER minibatches carry slot indices and sampling probabilities after the five columns
+                tensors = slot.fill(arrays[:5] + arrays[6:])
+                batch = tensors[:5] + arrays[5:6] + tensors[5:]
+                self.__ready.put((slot, batch))
+        except Exception as e:
+            self.__error = e
+            self.__ready.put((None, None))
+
+    def next(self):
+        if self.__in_use is not None:
+            self.__free.put(self.__in_use)
+        self.__in_use, batch = self.__ready.get()
+        if self.__error is not None:
+            raise self.__error
+        return batch
+
+    def stop(self):
+        self.__stop.set()
+        self.__thread.join()
@@ -0,0 +1,108 @@
+import json
+import time
+from collections import defaultdict
+import numpy as np
+import torch
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullTimer:
+    # default timer: phase() hands out one shared no-op context manager, so disabled instrumentation costs a
+    # method call per phase
+    enabled = False
+    __phase = _NullPhase()
+
+    def phase(self, name):
+        return self.__phase
+
+    def episode_report(self):
+        return ''
+
+    def summary(self):
+        return {}
+
+    def dump(self, fname):
+        pass
+
+
+class _Phase:
+    __slots__ = ('timer', 'name', 'start')
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timer.sync_cuda:
+            torch.cuda.synchronize()
+        self.timer.record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class PhaseTimer:
+    # accumulates wall time and call counts per named phase, both for the running episode and for the whole run
+    enabled = True
+
+    def __init__(self, sync_cuda=False):
+        # CUDA kernels run asynchronously; with sync_cuda every phase waits for them so the times are attributable
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.__episode_time = defaultdict(float)
+        self.__episode_calls = defaultdict(int)
+        self.__total_time = defaultdict(float)
+        self.__total_calls = defaultdict(int)
+
+    def phase(self, name):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return _Phase(self, name)
+
+    def record(self, name, elapsed):
+        self.__episode_time[name] += elapsed
+        self.__episode_calls[name] += 1
+
+    def episode_report(self):
+        # per-episode aggregates, folded into the run totals
+        report = '| '.join('{}: {:.1f}ms/{}'.format(name, 1e3 * self.__episode_time[name], self.__episode_calls[name])
+                           for name in self.__episode_time)
+        for name in self.__episode_time:
+            self.__total_time[name] += self.__episode_time[name]
+            self.__total_calls[name] += self.__episode_calls[name]
+        self.__episode_time.clear()
+        self.__episode_calls.clear()
+        return report
+
+    def summary(self):
+        return {name: {'total_sec': self.__total_time[name],
+                       'calls': self.__total_calls[name],
+                       'mean_ms': 1e3 * self.__total_time[name] / max(self.__total_calls[name], 1)}
+                for name in self.__total_time}
+
+    def dump(self, fname):
+        with open(fname, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
+
+
+def measure(fn, num_iters, warmup=5):
+    # runs fn num_iters times and reports throughput and per-call latency percentiles
+    for _ in range(warmup):
+        fn()
+    latencies = np.zeros(num_iters)
+    start = time.perf_counter()
+    for i in range(num_iters):
+        t = time.perf_counter()
+        fn()
+        latencies[i] = time.perf_counter() - t
+    elapsed = time.perf_counter() - start
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) * 1e3
+    return {'ops_per_sec': num_iters / elapsed, 'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99, 'iters': num_iters}
@@ -0,0 +1,47 @@
+import copy
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert, quantize_dynamic
+
+
+class _StaticQuantized(nn.Module):
+    # quantizes the observation on the way in and dequantizes the Q-values on the way out, so every layer of the
+    # wrapped network in between can run on int8 tensors
+    def __init__(self, net):
+        super(_StaticQuantized, self).__init__()
+        self.quant = QuantStub()
+        self.net = net
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.net(self.quant(x)))
+
+
+def quantize_net(net, mode='dynamic', calibration_states=None):
+    # Int8 CPU inference copy of a Q-network, in eval mode; net itself is left untouched.
+    #   'dynamic' - int8 weights of the Linear layers, activations quantized on the fly per call
+    #   'static'  - int8 weights and activations of every layer (convolutions included), with activation ranges
+    #               calibrated on calibration_states, a float tensor batch of typical observations
+    # Both use eager-mode module swapping rather than FX tracing, which patches nn.Module calls process-wide and
+    # so cannot run while other threads use their networks.
+    net = copy.deepcopy(net).to('cpu').eval()
+    if mode == 'dynamic':
+        return quantize_dynamic(net, {nn.Linear}, dtype=torch.qint8)
+    if mode != 'static':
+        raise KeyError('unknown quantization mode')
+    model = _StaticQuantized(net).eval()
+    model.qconfig = get_default_qconfig(torch.backends.quantized.engine)
+    prepared = prepare(model)
+    with torch.no_grad():
+        prepared(calibration_states)
+    return convert(prepared)
+
+
+def action_agreement(net, qnet, states):
+    # share of states on which the quantized copy picks the same greedy action as the float network in eval mode
+    training = net.training
+    net.eval()
+    with torch.no_grad():
+        agreement = (net(states).argmax(1) == qnet(states).argmax(1)).float().mean().item()
+    net.train(training)
+    return agreement
@@ -1,113 +1,950 @@
+import contextlib
+import json
+import multiprocessing
+import os
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 import random
-from collections import namedtuple, deque
 import torch
 
+from checkpoint import ArrayDelta
+
+
+def _item_shape(x):
+    # environments return observations with a leading batch axis of 1, e.g. (1, 37) or (1, C, F, H, W)
+    shape = np.shape(x)
+    return shape[1:] if len(shape) > 1 else shape
+
+
+class ArrayAllocator:
+    # allocates the replay arrays in process memory
+    persistent = False
+    shared = False
+    lock = None
+
+    def __call__(self, name, shape, dtype):
+        return np.zeros(shape, dtype=dtype)
+
+    def exists(self, name):
+        return False
+
+    def shape(self, name):
+        raise KeyError(name)
+
+    def flush(self):
+        pass
+
+
+class MemmapAllocator:
+    # Allocates every replay array as a memory-mapped .npy file in directory, so capacity is bounded by disk and
+    # the OS page cache keeps the hot part in RAM. Arrays that already exist are reopened, which lets a run pick
+    # its buffer up again after a crash.
+    persistent = True
+    shared = False
+    lock = None
+
+    def __init__(self, directory):
+        self.__directory = directory
+        self.__arrays = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.__directory, name + '.npy')
+
+    def __call__(self, name, shape, dtype):
+        if self.exists(name):
+            array = np.load(self._path(name), mmap_mode='r+')
+            if array.shape != tuple(shape) or array.dtype != np.dtype(dtype):
+                raise ValueError('{} holds a {} {} array, expected {} {}'.format(
+                    self._path(name), array.shape, array.dtype, tuple(shape), np.dtype(dtype)))
+        else:
+            array = np.lib.format.open_memmap(self._path(name), mode='w+', shape=tuple(shape), dtype=dtype)
+        self.__arrays[name] = array
+        return array
+
+    def exists(self, name):
+        return os.path.exists(self._path(name))
+
+    def shape(self, name):
+        return np.load(self._path(name), mmap_mode='r').shape
+
+    def flush(self):
+        for array in self.__arrays.values():
+            array.flush()
+
+
+class SharedMemoryAllocator:
+    # Allocates every replay array in its own multiprocessing.shared_memory segment, so that replay buffers built
+    # on the same allocator in several processes read and write the same arrays: actor processes add transitions
+    # in place and the learner samples from them without any pickling. Every segment starts with a small header
+    # holding the shape and dtype of its array, so other processes attach to the arrays by name alone.
+    # Pickling the allocator, e.g. as an argument of a process started from this one, passes its name and its
+    # lock; the copy attaches to the existing segments. The allocator created without a name owns the segments
+    # and unlinks them on close.
+    persistent = False
+    shared = True
+    header_size = 256
+
+    def __init__(self, name=None, lock=None):
+        self.name = 'replay_{}'.format(uuid.uuid4().hex[:12]) if name is None else name
+        # taken by the replay buffers around every add, sample and priority update, in all processes
+        self.lock = multiprocessing.get_context('spawn').RLock() if lock is None else lock
+        self.__owner = name is None
+        self.__segments = {}
+
+    def __getstate__(self):
+        return {'name': self.name, 'lock': self.lock}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'], state['lock'])
+
+    def _segment_name(self, name):
+        return '{}_{}'.format(self.name, name)
+
+    def _header(self, name):
+        # shape and dtype of an existing segment, which is attached on first use
+        segment = self.__segments.get(name)
+        if segment is None:
+            segment = self.__segments[name] = shared_memory.SharedMemory(self._segment_name(name))
+        header = json.loads(bytes(segment.buf[:self.header_size]).rstrip(b'\0'))
+        return segment, tuple(header['shape']), np.dtype(header['dtype'])
+
+    def __call__(self, name, shape, dtype):
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        if self.exists(name):
+            segment, saved_shape, saved_dtype = self._header(name)
+            if saved_shape != shape or saved_dtype != dtype:
+                raise ValueError('shared memory segment {} holds a {} {} array, expected {} {}'.format(
+                    self._segment_name(name), saved_shape, saved_dtype, shape, dtype))
+        else:
+            # new segments are zero-filled, as np.zeros
+            size = self.header_size + int(np.prod(shape)) * dtype.itemsize
+            segment = shared_memory.SharedMemory(self._segment_name(name), create=True, size=size)
+            header = json.dumps({'shape': list(shape), 'dtype': dtype.str}).encode()
+            segment.buf[:len(header)] = header
+            self.__segments[name] = segment
+        return np.ndarray(shape, dtype=dtype, buffer=segment.buf, offset=self.header_size)
+
+    def exists(self, name):
+        if name in self.__segments:
+            return True
+        try:
+            self.__segments[name] = shared_memory.SharedMemory(self._segment_name(name))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def shape(self, name):
+        return self._header(name)[1]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        # the owner unlinks the segments; their memory is released once every process has let go of its arrays
+        if self.__owner:
+            for segment in self.__segments.values():
+                segment.unlink()
+            self.__owner = False
+
+
+def make_allocator(storage_dir=None, allocator=None, **kwargs):
+    if allocator is not None:
+        return allocator
+    return MemmapAllocator(storage_dir) if storage_dir else ArrayAllocator()
+
+
+class NStepWindow:
+    # Rolling window over the last n_step transitions of one running episode. Once the window is full its oldest
+    # transition leaves it as the n-step transition
+    #   (state_t, action_t, r_t + gamma r_t+1 + ... + gamma^(n-1) r_t+n-1, state_t+n, done_t+n-1)
+    # whose target bootstraps with gamma^n. At the end of an episode the shorter windows left are all emitted as
+    # terminal transitions, which need no bootstrap. The discounted sum is taken over the at most n_step rewards of
+    # the window when a transition is emitted, so its rounding never depends on the episode's earlier rewards.
+    def __init__(self, n_step, gamma):
+        self.__n_step = n_step
+        self.__gamma = gamma
+        self.__items = deque()
+
+    def push(self, state, action, reward, next_state, done):
+        self.__items.append((state, action, reward))
+        if done:
+            return [self._pop(next_state, done) for _ in range(len(self.__items))]
+        if len(self.__items) == self.__n_step:
+            return [self._pop(next_state, done)]
+        return []
+
+    def _pop(self, next_state, done):
+        n_step_return = 0.
+        scale = 1.
+        for _, _, reward in self.__items:
+            n_step_return += scale * reward
+            scale *= self.__gamma
+        state, action, _ = self.__items.popleft()
+        return state, action, n_step_return, next_state, done
+
+
+class NStepWindows:
+    # one NStepWindow per environment, so interleaved episodes of vectorized or asynchronous actors stay apart
+    def __init__(self, n_step, gamma):
+        self.__n_step = n_step
+        self.__gamma = gamma
+        self.__windows = {}
+
+    def push(self, env_id, state, action, reward, next_state, done):
+        window = self.__windows.get(env_id)
+        if window is None:
+            window = self.__windows[env_id] = NStepWindow(self.__n_step, self.__gamma)
+        return window.push(state, action, reward, next_state, done)
+
+    def clear(self):
+        # drops the windows of the running episodes, e.g. when training resumes with freshly reset environments
+        self.__windows = {}
+
+
+class TransitionStorage:
+    # With n_step > 1 every add goes through a per-environment NStepWindow and the stored transitions are n-step
+    # ones: rewards hold the discounted n-step return and next_states the state n steps later.
+    def __init__(self, buffer_size, state_dtype=np.float32, allocator=None, n_step=1, gamma=0.99, state_shape=None):
+        self.__buffer_size = buffer_size
+        self.__state_dtype = state_dtype
+        self.__allocator = ArrayAllocator() if allocator is None else allocator
+        self.__columns = None
+        self.__windows = NStepWindows(n_step, gamma) if n_step > 1 else None
+        # insert position and number of stored transitions, kept next to the data so they persist with it
+        self.__counters = self.__allocator('counters', (2,), np.int64)
+        # transitions written so far, and up to which of them the state dicts have covered
+        self.__writes = self.__allocator('writes', (1,), np.int64)
+        self.__saved_writes = int(self.__writes[0]) - len(self)
+        if self.__allocator.exists('states'):
+            self._init_columns(self.__allocator.shape('states')[1:])
+        elif state_shape is not None:
+            self._init_columns(state_shape)
+
+    def _allocate(self, name, shape, dtype):
+        return self.__allocator(name, (self.__buffer_size,) + tuple(shape), dtype)
+
+    def _init_columns(self, state_shape):
+        self.__columns = (self._allocate('states', state_shape, self.__state_dtype),
+                          self._allocate('actions', (1,), np.int64),
+                          self._allocate('rewards', (1,), np.float32),
+                          self._allocate('next_states', state_shape, self.__state_dtype),
+                          self._allocate('dones', (1,), np.float32))
+
+    def add(self, state, action, reward, next_state, done, env_id=0):
+        # returns the slots written, none while an n-step window is still filling
+        if self.__columns is None:
+            self._init_columns(_item_shape(state))
+        if self.__windows is None:
+            return [self._write(state, action, reward, next_state, done)]
+        # the window keeps the state until n steps later, environments may reuse the array in between
+        return [self._write(*transition) for transition in
+                self.__windows.push(env_id, np.array(state), action, reward, next_state, done)]
+
+    def _write(self, state, action, reward, next_state, done):
+        states, actions, rewards, next_states, dones = self.__columns
+        pos, size = self.__counters
+        states[pos] = np.reshape(state, states.shape[1:])
+        actions[pos] = action
+        rewards[pos] = reward
+        next_states[pos] = np.reshape(next_state, next_states.shape[1:])
+        dones[pos] = done
+
+        self.__counters[:] = (pos + 1) % self.__buffer_size, min(size + 1, self.__buffer_size)
+        self.__writes[0] += 1
+        return pos
+
+    def add_batch(self, states, actions, rewards, next_states, dones, env_ids=None):
+        # n transitions with one vectorized write per column; only the newest buffer_size of them can be kept
+        if self.__windows is not None:
+            # n-step transitions are formed per episode, so raw transitions go through the windows one by one
+            env_ids = np.zeros(len(actions), dtype=np.int64) if env_ids is None else env_ids
+            return np.array([slot for i in range(len(actions))
+                             for slot in self.add(states[i:i + 1], actions[i], rewards[i], next_states[i:i + 1],
+                                                  dones[i], int(env_ids[i]))], dtype=np.int64)
+        n = len(actions)
+        skip = max(n - self.__buffer_size, 0)
+        if self.__columns is None:
+            self._init_columns(np.shape(states)[1:])
+        pos, size = self.__counters
+        slots = (pos + skip + np.arange(n - skip)) % self.__buffer_size
+        for column, values in zip(self.__columns, (states, actions, rewards, next_states, dones)):
+            column[slots] = np.reshape(values[skip:], (n - skip,) + column.shape[1:])
+        self.__counters[:] = (pos + n) % self.__buffer_size, min(size + n, self.__buffer_size)
+        self.__writes[0] += n
+        return slots
+
+    def gather(self, idxs):
+        # one fancy-index gather per column
+        return tuple(column[idxs] for column in self.__columns)
+
+    def flush(self):
+        self.__allocator.flush()
+
+    def _delta_slots(self):
+        # slots written since the previous state dict, at most the whole buffer
+        writes = int(self.__writes[0])
+        count = min(writes - self.__saved_writes, self.__buffer_size)
+        self.__saved_writes = writes
+        return (int(self.__counters[0]) - count + np.arange(count)) % self.__buffer_size
+
+    def state_dict(self):
+        # Columns come as ArrayDeltas of the slots written since the previous state dict, so every state dict has
+        # to go through the same CheckpointWriter. This holds for storages of any allocator: the arrays of a
+        # memmap allocator go on being overwritten after the checkpoint. The n-step windows of the running episodes
+        # are left out: a resumed run starts its episodes afresh.
+        state = {'counters': self.__counters.copy()}
+        if self.__columns is not None:
+            slots = self._delta_slots()
+            state['columns'] = tuple(ArrayDelta(column.shape, column.dtype, slots, column[slots])
+                                     for column in self.__columns)
+        return state
+
+    def load_state_dict(self, state):
+        # takes the whole columns, as load_checkpoint returns them
+        self.__counters[:] = state['counters']
+        if self.__windows is not None:
+            self.__windows.clear()
+        if 'columns' in state:
+            if self.__columns is None:
+                self._init_columns(state['columns'][0].shape[1:])
+            for column, saved in zip(self.__columns, state['columns']):
+                column[:] = saved
+        self.__saved_writes = int(self.__writes[0])
+
+    def capacity(self):
+        return self.__buffer_size
+
+    def __len__(self):
+        return int(self.__counters[1])
+
+
+class FrameStorage:
+    # Replay storage for stacked pixel observations of shape (1, C, num_stacked_frames, H, W), newest frame first.
+    # Every observed frame is kept once as uint8 together with a pointer to the previous frame of its episode,
+    # stacked states and next states are rebuilt from frame indices at gather time. With n_step > 1 the n-step
+    # windows hold frame indices, so a transition just points to the frame of the state n steps later.
+    def __init__(self, buffer_size, allocator=None, n_step=1, gamma=0.99, state_shape=None, **kwargs):
+        self.__buffer_size = buffer_size
+        self.__allocator = ArrayAllocator() if allocator is None else allocator
+        self.__n_step = n_step
+        self.__windows = NStepWindows(n_step, gamma) if n_step > 1 else None
+        self.__frames = None
+        self.__last_frame = {}  # newest frame of the running episode of each environment
+        # insert position, number of stored transitions, frames written and frames per stack
+        self.__counters = self.__allocator('frame_counters', (4,), np.int64)
+        # transitions written so far, and up to which transition and frame the state dicts have covered
+        self.__writes = self.__allocator('writes', (1,), np.int64)
+        self.__saved_writes = int(self.__writes[0]) - len(self)
+        self.__saved_frames = 0
+        if self.__allocator.exists('frames'):
+            frame_shape = self.__allocator.shape('frames')[1:]
+            self._init_columns((frame_shape[0], int(self.__counters[3])) + frame_shape[1:])
+        elif state_shape is not None:
+            self._init_columns(state_shape)
+
+    def _init_columns(self, stack_shape):
+        self.__stack_shape = tuple(stack_shape)
+        channels, self.__num_stacked_frames, height, width = self.__stack_shape
+        self.__counters[3] = self.__num_stacked_frames
+        # every transition pushes at most two frames (the reset frame and the next frame), so this many
+        # slots keep the frames of all live transitions and of those still in n-step windows; frames that fell out of
+        # the ring (possible only with many interleaved environments on a tiny buffer) are zero-padded
+        self.__frame_capacity = 2 * (self.__buffer_size + self.__n_step + self.__num_stacked_frames)
+        allocate = self.__allocator
+        self.__frames = allocate('frames', (self.__frame_capacity, channels, height, width), np.uint8)
+        self.__prev_frame = allocate('prev_frame', (self.__frame_capacity,), np.int64)
+        self.__state_frame = allocate('state_frame', (self.__buffer_size,), np.int64)
+        self.__next_frame = allocate('next_frame', (self.__buffer_size,), np.int64)
+        self.__actions = allocate('actions', (self.__buffer_size, 1), np.int64)
+        self.__rewards = allocate('rewards', (self.__buffer_size, 1), np.float32)
+        self.__dones = allocate('dones', (self.__buffer_size, 1), np.float32)
+
+    def _push_frame(self, stacked, prev):
+        frame = np.reshape(stacked, (1,) + self.__stack_shape)[0, :, 0]
+        if frame.dtype != np.uint8:
+            # observations come in as floats in [0, 1]
+            frame = np.rint(frame * 255.)
+        frame_id = int(self.__counters[2])
+        pos = frame_id % self.__frame_capacity
+        self.__frames[pos] = frame
+        self.__prev_frame[pos] = prev
+        self.__counters[2] = frame_id + 1
+        return frame_id
+
+    def add(self, state, action, reward, next_state, done, env_id=0):
+        if self.__frames is None:
+            self._init_columns(_item_shape(state))
+        state_frame = self.__last_frame.pop(env_id, -1)
+        if state_frame < 0:
+            # first transition of an episode, its state frame has not been seen yet
+            state_frame = self._push_frame(state, -1)
+        next_frame = self._push_frame(next_state, state_frame)
+        if not done:
+            self.__last_frame[env_id] = next_frame
+        if self.__windows is None:
+            return [self._write(state_frame, action, reward, next_frame, done)]
+        return [self._write(*transition) for transition in
+                self.__windows.push(env_id, state_frame, action, reward, next_frame, done)]
+
+    def _write(self, state_frame, action, reward, next_frame, done):
+        pos, size = self.__counters[:2]
+        self.__state_frame[pos] = state_frame
+        self.__next_frame[pos] = next_frame
+        self.__actions[pos] = action
+        self.__rewards[pos] = reward
+        self.__dones[pos] = done
+
+        self.__counters[:2] = (pos + 1) % self.__buffer_size, min(size + 1, self.__buffer_size)
+        self.__writes[0] += 1
+        return pos
+
+    def add_batch(self, states, actions, rewards, next_states, dones, env_ids=None):
+        # frames are chained per episode, so transitions go in one by one
+        env_ids = np.zeros(len(actions), dtype=np.int64) if env_ids is None else env_ids
+        return np.array([slot for i in range(len(actions))
+                         for slot in self.add(states[i:i + 1], actions[i], rewards[i], next_states[i:i + 1], dones[i],
+                                              int(env_ids[i]))], dtype=np.int64)
+
+    def _stack(self, frame_ids):
+        k = len(frame_ids)
+        stacked = np.zeros((k, self.__frames.shape[1], self.__num_stacked_frames) + self.__frames.shape[2:],
+                           dtype=np.uint8)
+        oldest = max(int(self.__counters[2]) - self.__frame_capacity, 0)
+        for j in range(self.__num_stacked_frames):
+            # frames before the episode start (or already overwritten) stay zero, as in the environment
+            valid = frame_ids >= oldest
+            pos = frame_ids[valid] % self.__frame_capacity
+            stacked[valid, :, j] = self.__frames[pos]
+            frame_ids = np.full(k, -1, dtype=np.int64)
+            frame_ids[valid] = self.__prev_frame[pos]
+        return stacked
+
+    def gather(self, idxs):
+        return (self._stack(self.__state_frame[idxs]),
+                self.__actions[idxs],
+                self.__rewards[idxs],
+                self._stack(self.__next_frame[idxs]),
+                self.__dones[idxs])
+
+    def flush(self):
+        self.__allocator.flush()
+
+    def _columns(self):
+        return (self.__frames, self.__prev_frame, self.__state_frame, self.__next_frame, self.__actions,
+                self.__rewards, self.__dones)
+
+    def _delta_slots(self):
+        # frame slots and transition slots written since the previous state dict, at most the whole rings
+        frames = int(self.__counters[2])
+        frame_ids = np.arange(max(self.__saved_frames, frames - self.__frame_capacity), frames)
+        self.__saved_frames = frames
+        writes = int(self.__writes[0])
+        count = min(writes - self.__saved_writes, self.__buffer_size)
+        self.__saved_writes = writes
+        slots = (int(self.__counters[0]) - count + np.arange(count)) % self.__buffer_size
+        return frame_ids % self.__frame_capacity, slots
+
+    def state_dict(self):
+        # columns come as ArrayDeltas of what was written since the previous state dict and running episodes are
+        # left out, see TransitionStorage; a resumed run chains its frames from new episodes
+        state = {'counters': self.__counters.copy()}
+        if self.__frames is not None:
+            state['stack_shape'] = self.__stack_shape
+            frame_slots, slots = self._delta_slots()
+            state['columns'] = tuple(ArrayDelta(column.shape, column.dtype, idxs, column[idxs]) for column, idxs in
+                                     zip(self._columns(), (frame_slots, frame_slots) + (slots,) * 5))
+        return state
+
+    def load_state_dict(self, state):
+        # takes the whole columns, as load_checkpoint returns them
+        self.__counters[:] = state['counters']
+        self.__last_frame = {}
+        if self.__windows is not None:
+            self.__windows.clear()
+        if 'stack_shape' in state and self.__frames is None:
+            self._init_columns(state['stack_shape'])
+        if 'columns' in state:
+            for column, saved in zip(self._columns(), state['columns']):
+                column[:] = saved
+        self.__saved_writes = int(self.__writes[0])
+        self.__saved_frames = int(self.__counters[2])
+
+    def capacity(self):
+        return self.__buffer_size
+
+    def __len__(self):
+        return int(self.__counters[1])
+
+
+def make_storage(buffer_size, env_type=None, allocator=None, n_step=1, gamma=0.99, state_shape=None, **kwargs):
+    # state_shape, the shape of one state without the batch axis, allocates the columns up front instead of on
+    # the first add; shared-memory storages need it, so that every process attaches to the same columns
+    if state_shape is None and allocator is not None and allocator.shared:
+        raise ValueError('shared-memory replay storage needs the state_shape')
+    if env_type == 'visual':
+        return FrameStorage(buffer_size, allocator=allocator, n_step=n_step, gamma=gamma, state_shape=state_shape,
+                            **kwargs)
+    return TransitionStorage(buffer_size, allocator=allocator, n_step=n_step, gamma=gamma, state_shape=state_shape)
+
+
+def states_to_tensor(device, states):
+    if states.dtype == np.uint8:
+        # frames are moved as bytes and scaled back to [0, 1] on the device
+        return torch.from_numpy(states).to(device).float().div_(255.)
+    return torch.from_numpy(states).float().to(device)
+
+
+def to_tensors(device, states, actions, rewards, next_states, dones):
+    return (states_to_tensor(device, states),
+            torch.from_numpy(actions).long().to(device),
+            torch.from_numpy(rewards).float().to(device),
+            states_to_tensor(device, next_states),
+            torch.from_numpy(dones).float().to(device))
+
 
 class ReplayBuffer:
+    # With a SharedMemoryAllocator (allocator=...) the buffer can be built in several processes over the same
+    # arrays: every process adds in place and any of them samples. Each operation then holds the allocator's lock,
+    # and env_ids have to be unique across processes, since frame chaining and n-step windows are per process.
     def __init__(self, buffer_size=int(1e4), minibatch_size=64, seed=0, **kwargs):
-        self.__deque = deque(maxlen=buffer_size)
-        self.__experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "done"])
+        allocator = make_allocator(**kwargs)
+        self.__storage = make_storage(buffer_size, **dict(kwargs, allocator=allocator))
+        self.__lock = contextlib.nullcontext() if allocator.lock is None else allocator.lock
         self.__minibatch_size = minibatch_size
         self.__seed = random.seed(seed)
         self.__device = kwargs['device']
 
-    def add(self, state, action, reward, next_state, done):
-        experience = self.__experience(state, action, reward, next_state, done)
-        self.__deque.append(experience)
+    def add(self, state, action, reward, next_state, done, env_id=0):
+        with self.__lock:
+            self.__storage.add(state, action, reward, next_state, done, env_id)
+
+    def add_batch(self, states, actions, rewards, next_states, dones, env_ids=None):
+        with self.__lock:
+            self.__storage.add_batch(states, actions, rewards, next_states, dones, env_ids)
 
     def sample(self):
+        return to_tensors(self.__device, *self.sample_arrays())
+
+    def sample_arrays(self):
+        # the minibatch as NumPy columns, before conversion to tensors
         k = self.__minibatch_size
-        experiences = random.sample(self.__deque, k)
-        states = torch.from_numpy(np.vstack([e.state for e in experiences if e is not None])).float().to(self.__device)
-        actions = torch.from_numpy(np.vstack([e.action for e in experiences if e is not None])).long().to(self.__device)
-        rewards = torch.from_numpy(np.vstack([e.reward for e in experiences if e is not None])).float().to(self.__device)
-        next_states = torch.from_numpy(np.vstack([e.next_state for e in experiences if e is not None])).float().to(self.__device)
-        dones = torch.from_numpy(np.vstack([e.done for e in experiences if e is not None]).astype(np.uint8)).float().to(self.__device)
+        with self.__lock:
+            idxs = np.array(random.sample(range(len(self.__storage)), k))
+            return self.__storage.gather(idxs)
 
-        return states, actions, rewards, next_states, dones
+    def sample_states(self, k):
+        # k uniformly drawn states, e.g. to calibrate a quantized network
+        with self.__lock:
+            return self.__storage.gather(np.random.randint(0, len(self.__storage), k))[0]
 
     def size(self):
-        return len(self.__deque)
+        return len(self.__storage)
+
+    def flush(self):
+        self.__storage.flush()
+
+    def state_dict(self):
+        with self.__lock:
+            return {'storage': self.__storage.state_dict()}
+
+    def load_state_dict(self, state):
+        with self.__lock:
+            self.__storage.load_state_dict(state['storage'])
+
+
+class SumTree:
+    def __init__(self, capacity, allocator=None):
+        self.__capacity = capacity
+        # leaves are padded to a power of two so that every leaf sits at the same depth
+        self.__depth = int(np.ceil(np.log2(max(capacity, 1))))
+        self.__num_leaves = 1 << self.__depth
+        self.__allocator = ArrayAllocator() if allocator is None else allocator
+        self.__keys = self.__allocator('sum_tree', (2 * self.__num_leaves,), np.float64)
+        # largest key set so far
+        self.__max_key = self.__allocator('sum_tree_max', (1,), np.float64)
+
+    def total(self):
+        return self.__keys[1]
+
+    def max_key(self):
+        # the priority new transitions enter the tree with, as in standard prioritized replay: the largest key set
+        # so far, or 1 before the first one
+        return float(self.__max_key[0]) if self.__max_key[0] > 0 else 1.
+
+    def get(self, idxs):
+        return self.__keys[np.asarray(idxs) + self.__num_leaves]
+
+    def update(self, idxs, keys):
+        if np.ndim(idxs) > 0 and len(idxs) == 0:
+            return
+        if np.ndim(idxs) == 0 or len(idxs) == 1:
+            self._update_leaf(int(np.ravel(idxs)[0]), float(np.ravel(keys)[0]))
+            return
+        idxs = np.asarray(idxs, dtype=np.int64).ravel()
+        keys = np.broadcast_to(np.asarray(keys, dtype=np.float64).ravel(), idxs.shape)
+        # for duplicated indices the last written key wins
+        idxs, last = np.unique(idxs[::-1], return_index=True)
+        nodes = idxs + self.__num_leaves
+        self.__keys[nodes] = keys[::-1][last]
+        self.__max_key[0] = max(self.__max_key[0], keys.max())
+        # recompute parents level by level; a parent shared by several updated children is written several times,
+        # always with the same value, which is cheaper than deduplicating the nodes of every level
+        for _ in range(self.__depth):
+            nodes = nodes // 2
+            self.__keys[nodes] = self.__keys[2 * nodes] + self.__keys[2 * nodes + 1]
+
+    def _update_leaf(self, idx, key):
+        # one leaf and its path to the root with scalar operations, much cheaper than the batched update for the
+        # single transitions that shared-memory buffers add one at a time
+        keys = self.__keys
+        node = idx + self.__num_leaves
+        keys[node] = key
+        if key > self.__max_key[0]:
+            self.__max_key[0] = key
+        for _ in range(self.__depth):
+            node //= 2
+            keys[node] = keys[2 * node] + keys[2 * node + 1]
+
+    def sample(self, k, rng):
+        # stratified sampling: one target per segment, all targets descend the tree together
+        return self.find((np.arange(k) + rng.uniform(size=k)) * (self.total() / k))
+
+    def find(self, targets):
+        # the leaves whose cumulative key ranges contain the targets, which lie in [0, total)
+        targets = np.asarray(targets, dtype=np.float64)
+        nodes = np.ones(len(targets), dtype=np.int64)
+        for _ in range(self.__depth):
+            left = 2 * nodes
+            left_keys = self.__keys[left]
+            go_right = (targets >= left_keys) & (self.__keys[left + 1] > 0)
+            targets = np.where(go_right, targets - left_keys, targets)
+            nodes = left + go_right
+        return nodes - self.__num_leaves
+
+    def state_dict(self):
+        # the keys are a small fraction of the replay data and change all over the tree, so they are copied whole
+        return {'keys': self.__keys.copy(), 'max_key': float(self.__max_key[0])}
+
+    def load_state_dict(self, state):
+        if 'keys' in state:
+            self.__keys[:] = state['keys']
+        self.__max_key[0] = state.get('max_key', 0.)
 
 
 class PrioritizedReplayBuffer:
+    # Shared-memory buffers (see ReplayBuffer) keep the sum-tree, and the largest priority set so far, in shared
+    # memory as well. Slots pending for the next minibatch would only be known to the process that added them, so
+    # there new transitions enter the sum-tree directly at that largest priority, as bulk loads do. Buffers on a
+    # persistent (memmap) allocator put new transitions into the sum-tree at that priority as well, besides queueing
+    # them for the next minibatch, so that a buffer reopened after a crash samples them too.
     def __init__(self, buffer_size=int(1e4), minibatch_size=64, seed=0, **kwargs):
-        self.__deque = deque(maxlen=buffer_size)
-        self.__keys = np.zeros(2 * buffer_size)
-        self.__experiences = np.zeros(buffer_size, dtype=object)
-        self.__len = 0
-        self.__insert_pos = 0
-        self.__experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "done"])
+        allocator = make_allocator(**kwargs)
+        self.__storage = make_storage(buffer_size, **dict(kwargs, allocator=allocator))
+        self.__tree = SumTree(buffer_size, allocator=allocator)
+        self.__shared = allocator.shared
+        self.__persistent = allocator.persistent
+        self.__lock = contextlib.nullcontext() if allocator.lock is None else allocator.lock
+        # slots added since the last sample: they go into the next minibatch and then into the tree
+        self.__pending = []
         self.__minibatch_size = minibatch_size
         self.__seed = random.seed(seed)
-        self.__buffer_size = buffer_size
+        self.__rng = np.random.RandomState(seed)
         self.__device = kwargs['device']
 
-    def add(self, state, action, reward, next_state, done):
-        experience = self.__experience(state, action, reward, next_state, done)
-        self.__deque.append(experience)
+    def add(self, state, action, reward, next_state, done, env_id=0):
+        with self.__lock:
+            slots = self.__storage.add(state, action, reward, next_state, done, env_id)
+            if len(slots) and (self.__shared or self.__persistent):
+                self.__tree.update(slots, self.__tree.max_key())
+            if not self.__shared:
+                self.__pending.extend(slots)
+
+    def add_batch(self, states, actions, rewards, next_states, dones, env_ids=None):
+        # bulk loads go straight into the sum-tree with the priority of new transitions instead of being queued
+        # for the next minibatch; that is the same for every chunk of a load, so they are all sampled alike
+        with self.__lock:
+            slots = self.__storage.add_batch(states, actions, rewards, next_states, dones, env_ids)
+            if len(slots):
+                self.__tree.update(slots, self.__tree.max_key())
 
-    def _add_to_tree(self, experience, key):
-        idx = self.__insert_pos + self.__buffer_size
+    def sample(self):
+        samples = self.sample_arrays()
+        idxs, probs = samples[5:]
+        return to_tensors(self.__device, *samples[:5]) + (idxs, torch.from_numpy(probs).to(self.__device))
 
-        self.__experiences[self.__insert_pos] = experience
-        if self.__len < self.__buffer_size:
-            self.__len += 1
+    def sample_arrays(self):
+        with self.__lock:
+            pending = np.array(self.__pending, dtype=np.int64)
+            self.__pending = []
+            k = max(self.__minibatch_size - len(pending), 0)
+            size = self.size()
 
-        self.__insert_pos = (self.__insert_pos + 1) % self.__buffer_size
-        self._update_tree(idx, key)
-        return idx
+            total = self.__tree.total()
+            idxs = self.__tree.sample(k, self.__rng) if k > 0 else np.zeros(0, dtype=np.int64)
+            probs = self.__tree.get(idxs) / total if k > 0 else np.zeros(0)
 
-    def sample(self):
-        k = self.__minibatch_size - len(self.__deque)
+            # pending slots are forced into the minibatch, their sampling probability is taken as 1/size; in the
+            # tree they start with the priority of new transitions until the learner updates them
+            self.__tree.update(pending, self.__tree.max_key())
+            idxs = np.concatenate((idxs, pending))
+            probs = np.concatenate((probs, np.full(len(pending), 1. / size)))
+
+            return self.__storage.gather(idxs) + (idxs, probs.astype(np.float32))
+
+    def update(self, idxs, new_keys):
+        with self.__lock:
+            self.__tree.update(idxs, new_keys)
+
+    def sample_states(self, k):
+        # k uniformly drawn states, e.g. to calibrate a quantized network; priorities and pending slots are untouched
+        with self.__lock:
+            return self.__storage.gather(np.random.randint(0, len(self.__storage), k))[0]
+
+    def size(self):
+        return len(self.__storage)
+
+    def total(self):
+        return self.__tree.total()
+
+    def flush(self):
+        # transitions still pending are not in the sum-tree yet; flushing them makes a reopened buffer complete
+        with self.__lock:
+            pending = np.array(self.__pending, dtype=np.int64)
+            self.__pending = []
+            if len(pending):
+                self.__tree.update(pending, self.__tree.max_key())
+            self.__storage.flush()
+
+    def state_dict(self):
+        with self.__lock:
+            return {'storage': self.__storage.state_dict(),
+                    'tree': self.__tree.state_dict(),
+                    'pending': list(self.__pending),
+                    'rng': self.__rng.get_state()}
+
+    def load_state_dict(self, state):
+        with self.__lock:
+            self.__storage.load_state_dict(state['storage'])
+            self.__tree.load_state_dict(state['tree'])
+            self.__pending = list(state['pending'])
+            self.__rng.set_state(state['rng'])
+
+
+class _PrioritizedShard:
+    # storage, sum-tree, lock and pending slots of one shard of a ShardedPrioritizedReplayBuffer
+    def __init__(self, buffer_size, allocator, **kwargs):
+        self.__storage = make_storage(buffer_size, **dict(kwargs, allocator=allocator))
+        self.__tree = SumTree(buffer_size, allocator=allocator)
+        self.__shared = allocator.shared
+        self.__persistent = allocator.persistent
+        self.__lock = contextlib.nullcontext() if allocator.lock is None else allocator.lock
+        self.__pending = []
+
+    def add(self, transition, env_id, new_priority):
+        # new_priority() is the priority of new transitions, which shared and persistent shards put into the sum-tree
+        # right away, as PrioritizedReplayBuffer does
+        with self.__lock:
+            slots = self.__storage.add(*transition, env_id)
+            if len(slots) and (self.__shared or self.__persistent):
+                self.__tree.update(slots, new_priority())
+            if not self.__shared:
+                self.__pending.extend(slots)
+
+    def add_batch(self, columns, env_ids, new_priority):
+        with self.__lock:
+            slots = self.__storage.add_batch(*columns, env_ids)
+            if len(slots):
+                self.__tree.update(slots, new_priority())
+
+    def sample(self, targets, priority):
+        # the slots at the targets (offsets into this shard's total) with their keys, and the pending slots, which
+        # enter the sum-tree with priority; the gathered columns come first
+        with self.__lock:
+            pending = np.array(self.__pending, dtype=np.int64)
+            self.__pending = []
+            idxs = self.__tree.find(targets) if len(targets) else np.zeros(0, dtype=np.int64)
+            keys = self.__tree.get(idxs)
+            self.__tree.update(pending, priority)
+            idxs = np.concatenate((idxs, pending))
+            keys = np.concatenate((keys, np.full(len(pending), np.nan)))
+            return self.__storage.gather(idxs), idxs, keys
+
+    def update(self, idxs, keys):
+        with self.__lock:
+            self.__tree.update(idxs, keys)
+
+    def sample_states(self, k):
+        with self.__lock:
+            return self.__storage.gather(np.random.randint(0, len(self.__storage), k))[0]
+
+    def num_pending(self):
+        return len(self.__pending)
+
+    def total(self):
+        return self.__tree.total()
+
+    def max_key(self):
+        return self.__tree.max_key()
+
+    def size(self):
+        return len(self.__storage)
+
+    def flush(self, priority):
+        with self.__lock:
+            pending = np.array(self.__pending, dtype=np.int64)
+            self.__pending = []
+            if len(pending):
+                self.__tree.update(pending, priority)
+            self.__storage.flush()
 
-        total = self.__keys[1]
-        idxs = [self._sift(random.uniform(seg / k, (seg + 1) / k) * total) for seg in range(k)]
-        probs = [self.__keys[i] / total for i in idxs]
-        samples = [self.__experiences[i - self.__buffer_size] for i in idxs]
+    def state_dict(self):
+        with self.__lock:
+            return {'storage': self.__storage.state_dict(), 'tree': self.__tree.state_dict(),
+                    'pending': list(self.__pending)}
 
-        # add elems from deque
+    def load_state_dict(self, state):
+        with self.__lock:
+            self.__storage.load_state_dict(state['storage'])
+            self.__tree.load_state_dict(state['tree'])
+            self.__pending = list(state['pending'])
+
+
+class ShardedPrioritizedReplayBuffer:
+    # Prioritized replay split into num_shards independent shards, each with its own storage, sum-tree and lock
+    # (and its own allocator from allocators, e.g. one SharedMemoryAllocator per shard, so that adds of different
+    # processes to different shards never wait for each other; a single allocator= is rejected). Whole episodes go to one shard, the shards taking
+    # turns episode by episode, so frame chains and n-step windows never straddle shards.
+    # A minibatch is drawn as from one sum-tree over all shards: the stratified targets in [0, global total) are
+    # routed to the shards through the cumulative shard totals, so shards are picked in proportion to their total
+    # priority, and every shard then resolves its own targets, on a thread pool when sample_threads > 0.
+    # Sampled indices are global (shard * shard_size + slot) and priority updates are routed back to the owning
+    # shard. Sampling probabilities are key / global total and new transitions get the largest priority of all
+    # shards, so importance weights computed from them and size() are the same as for a single
+    # PrioritizedReplayBuffer.
+    def __init__(self, buffer_size=int(1e4), minibatch_size=64, seed=0, num_shards=4, allocators=None,
+                 sample_threads=0, **kwargs):
+        self.__num_shards = num_shards
+        self.__shard_size = -(-buffer_size // num_shards)
+        if kwargs.get('allocator') is not None:
+            # one allocator would put every shard's arrays under the same names
+            raise ValueError('sharded replay buffers take one allocator per shard, pass allocators=[...] instead')
+        if allocators is None:
+            storage_dir = kwargs.get('storage_dir')
+            allocators = [make_allocator(os.path.join(storage_dir, 'shard_{}'.format(i)) if storage_dir else None)
+                          for i in range(num_shards)]
+        kwargs = {key: value for key, value in kwargs.items() if key not in ('allocator', 'storage_dir')}
+        self.__shards = [_PrioritizedShard(self.__shard_size, allocator, **kwargs) for allocator in allocators]
+        self.__executor = ThreadPoolExecutor(sample_threads) if sample_threads > 0 else None
+        # shard of the running episode of each environment, and the shard the next episode goes to
+        self.__episode_shard = {}
+        self.__next_shard = 0
+        self.__minibatch_size = minibatch_size
+        self.__seed = random.seed(seed)
+        self.__rng = np.random.RandomState(seed)
+        self.__device = kwargs['device']
+
+    def _new_priority(self):
+        return max(shard.max_key() for shard in self.__shards)
+
+    def _shard_of_episode(self, env_id):
+        shard = self.__episode_shard.get(env_id)
+        if shard is None:
+            shard = self.__episode_shard[env_id] = self.__next_shard
+            self.__next_shard = (self.__next_shard + 1) % self.__num_shards
+        return shard
+
+    def add(self, state, action, reward, next_state, done, env_id=0):
+        shard = self._shard_of_episode(env_id)
+        if done:
+            del self.__episode_shard[env_id]
+        self.__shards[shard].add((state, action, reward, next_state, done), env_id, self._new_priority)
+
+    def add_batch(self, states, actions, rewards, next_states, dones, env_ids=None):
+        # bulk loads go straight into the sum-trees, every run of transitions to one shard in one call
+        env_ids = np.zeros(len(actions), dtype=np.int64) if env_ids is None else np.asarray(env_ids)
+        shards = np.empty(len(actions), dtype=np.int64)
+        for i in range(len(actions)):
+            shards[i] = self._shard_of_episode(int(env_ids[i]))
+            if dones[i]:
+                del self.__episode_shard[int(env_ids[i])]
+        starts = np.flatnonzero(np.diff(shards, prepend=-1))
+        for start, end in zip(starts, np.append(starts[1:], len(actions))):
+            columns = tuple(values[start:end] for values in (states, actions, rewards, next_states, dones))
+            self.__shards[shards[start]].add_batch(columns, env_ids[start:end], self._new_priority)
+
+    def sample(self):
+        samples = self.sample_arrays()
+        idxs, probs = samples[5:]
+        return to_tensors(self.__device, *samples[:5]) + (idxs, torch.from_numpy(probs).to(self.__device))
+
+    def sample_arrays(self):
         size = self.size()
-        for v in self.__deque:
-            samples.append(v)
-            idx = self._add_to_tree(v, 1. / size)
-            idxs.append(idx)
-            probs.append(1. / size)
-        self.__deque.clear()
-
-        states = torch.from_numpy(np.vstack([e.state for e in samples if e is not None])).float().to(self.__device)
-        actions = torch.from_numpy(np.vstack([e.action for e in samples if e is not None])).long().to(self.__device)
-        rewards = torch.from_numpy(np.vstack([e.reward for e in samples if e is not None])).float().to(self.__device)
-        next_states = torch.from_numpy(np.vstack([e.next_state for e in samples if e is not None])).float().to(self.__device)
-        dones = torch.from_numpy(np.vstack([e.done for e in samples if e is not None]).astype(np.uint8)).float().to(self.__device)
-        idxs = torch.Tensor(idxs).long().to(self.__device)
-        probs = torch.Tensor(probs).float().to(self.__device)
-        return states, actions, rewards, next_states, dones, idxs, probs
+        k = max(self.__minibatch_size - sum(shard.num_pending() for shard in self.__shards), 0)
+        totals = np.array([shard.total() for shard in self.__shards])
+        total = totals.sum()
+        k = k if total > 0 else 0
+        targets = (np.arange(k) + self.__rng.uniform(size=k)) * (total / k) if k > 0 else np.zeros(0)
+        # targets at the very end of the range (rounding) belong to the last shard with any priority
+        ends = np.cumsum(totals)
+        owners = np.minimum(np.searchsorted(ends, targets, side='right'), np.flatnonzero(totals > 0)[-1]) \
+            if k > 0 else np.zeros(0, dtype=np.int64)
+        offsets = ends - totals
+        new_priority = self._new_priority()
+
+        def sample_shard(i):
+            mask = owners == i
+            return self.__shards[i].sample(np.minimum(targets[mask] - offsets[i], totals[i]), new_priority)
+
+        # shards without targets or pending slots have nothing to contribute (and may not hold any data yet)
+        sampled = [i for i in range(self.__num_shards) if np.any(owners == i) or self.__shards[i].num_pending()]
+        map_fn = map if self.__executor is None else self.__executor.map
+        columns, idxs, probs = [], [], []
+        for i, (shard_columns, shard_idxs, keys) in zip(sampled, map_fn(sample_shard, sampled)):
+            columns.append(shard_columns)
+            idxs.append(shard_idxs + i * self.__shard_size)
+            # pending slots come with a nan key and are sampled with the priority of new transitions
+            probs.append(np.where(np.isnan(keys), 1. / size, keys / total if total > 0 else 0.))
+        columns = tuple(np.concatenate(column) for column in zip(*columns))
+        return columns + (np.concatenate(idxs), np.concatenate(probs).astype(np.float32))
 
     def update(self, idxs, new_keys):
-        for idx, key in zip(idxs, new_keys):
-            self._update_tree(idx, key)
+        idxs = np.asarray(idxs, dtype=np.int64).ravel()
+        new_keys = np.broadcast_to(np.asarray(new_keys, dtype=np.float64).ravel(), idxs.shape)
+        shards = idxs // self.__shard_size
+        for i in np.unique(shards):
+            mask = shards == i
+            self.__shards[i].update(idxs[mask] - i * self.__shard_size, new_keys[mask])
+
+    def sample_states(self, k):
+        # k states drawn uniformly over the shards' contents
+        sizes = np.array([shard.size() for shard in self.__shards])
+        counts = self.__rng.multinomial(k, sizes / sizes.sum())
+        return np.concatenate([shard.sample_states(n) for shard, n in zip(self.__shards, counts) if n > 0])
 
     def size(self):
-        return self.__len + len(self.__deque)
+        return sum(shard.size() for shard in self.__shards)
 
     def total(self):
-        return self.__keys[1]
+        return sum(shard.total() for shard in self.__shards)
+
+    def flush(self):
+        priority = self._new_priority()
+        for shard in self.__shards:
+            shard.flush(priority)
+
+    def state_dict(self):
+        # as in the storages, running episodes are left out
+        return {'shards': [shard.state_dict() for shard in self.__shards],
+                'next_shard': self.__next_shard,
+                'rng': self.__rng.get_state()}
 
-    def _update_tree(self, idx, key):
-        delta = key - self.__keys[idx]
-        while idx >= 1:
-            self.__keys[idx] += delta
-            idx = idx // 2
-
-    def _sift(self, rn):
-        i = 1
-
-        while i < self.__buffer_size:
-            if self.__keys[2*i] > rn:
-                i *= 2
-            else:
-                rn = rn - self.__keys[2*i]
-                i = i * 2 + 1
-        return i
+    def load_state_dict(self, state):
+        for shard, shard_state in zip(self.__shards, state['shards']):
+            shard.load_state_dict(shard_state)
+        self.__episode_shard = {}
+        self.__next_shard = state['next_shard']
+        self.__rng.set_state(state['rng'])
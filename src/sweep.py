@@ -0,0 +1,162 @@
+from train import train, make_parser
+from metrics import read_metrics
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing as mp
+import os
+import time
+import traceback
+import numpy as np
+import torch
+
+
+def expand_grid(grid):
+    # {'lr': [1e-4, 5e-4], 'agent_type': ['dqn']} -> one config per combination
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+
+# train.py params that only say where a run writes its outputs (or how it resumes), left out of the config keys
+OUTPUT_PARAMS = ('run_name', 'model_dir', 'reports_dir', 'storage_dir', 'checkpoint_dir', 'record_dir', 'worker_id',
+                 'resume')
+
+
+def config_key(config):
+    # stable name of a config, i.e. of all train.py params of a run: its readable values plus a hash of every param
+    # that can change the results
+    config = {k: v for k, v in config.items() if k not in OUTPUT_PARAMS}
+    digest = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:10]
+    name = '_'.join('{}-{}'.format(k, config[k]) for k in sorted(config) if k in ('env_type', 'agent_type'))
+    return '{}_{}'.format(name, digest) if name else digest
+
+
+def _run_job(job):
+    # runs in a pool process: one training run with its own thread budget, results go to job['result_fname']
+    torch.set_num_threads(job['threads'])
+    start = time.time()
+    try:
+        results = train(**job['kwargs'])
+        status = 'done'
+    except Exception:
+        results = {'error': traceback.format_exc()}
+        status = 'failed'
+    results.update(config=job['config'], status=status, elapsed_sec=time.time() - start)
+    if status == 'done':
+        with open(job['result_fname'] + '.tmp', 'w') as f:
+            json.dump(results, f)
+        os.replace(job['result_fname'] + '.tmp', job['result_fname'])
+    return job['key'], results
+
+
+def rolling_mean(values, window=100):
+    return [np.mean(values[max(i - window + 1, 0):i + 1]) for i in range(len(values))]
+
+
+def summarize(results):
+    # score, loss and timing aggregates of a run for the results index
+    scores = results.get('scores', [])
+    losses = results.get('losses', [])
+    summary = {'config': results['config'], 'status': results['status'], 'elapsed_sec': results['elapsed_sec']}
+    if scores:
+        avg_scores = rolling_mean(scores)
+        summary.update(episodes=len(scores), final_avg_score=float(avg_scores[-1]),
+                       best_avg_score=float(np.max(avg_scores)),
+                       sec_per_episode=results['elapsed_sec'] / len(scores))
+    if losses:
+        summary.update(final_avg_loss=float(rolling_mean(losses)[-1]), mean_loss=float(np.mean(losses)))
+    if results.get('metrics_fname') and os.path.exists(results['metrics_fname']):
+        records = read_metrics(results['metrics_fname'])
+        if records:
+            summary['steps_per_sec'] = records[-1]['steps_per_sec']
+    if results.get('timing'):
+        # mean wall time per call of every profiled phase
+        summary['phase_ms'] = {name: phase['mean_ms'] for name, phase in results['timing'].items()}
+    if 'error' in results:
+        summary['error'] = results['error'].strip().splitlines()[-1]
+    return summary
+
+
+def run_sweep(configs, base_kwargs, sweep_dir, num_workers=2, threads_per_job=1, model_dir=None, reports_dir=None):
+    # Trains every config (a dict of overrides of base_kwargs) in a pool of num_workers processes. Each job gets
+    # its own directory and a disjoint range of Unity worker ports; jobs whose results already exist in sweep_dir
+    # are skipped, so an interrupted sweep is resumed by rerunning it. Jobs are keyed by all their params, so rerunning
+    # with other base_kwargs runs every config again. Models and reports go to the job directory, or to
+    # <model_dir>/<key> and <reports_dir>/<key> if those are given. Returns the results index, which is also kept up
+    # to date in sweep_dir/index.json.
+    os.makedirs(sweep_dir, exist_ok=True)
+    index_fname = os.path.join(sweep_dir, 'index.json')
+    index = {}
+    if os.path.exists(index_fname):
+        with open(index_fname) as f:
+            index = json.load(f)
+
+    jobs = []
+    worker_id = base_kwargs.get('worker_id', 0)
+    for config in configs:
+        kwargs = dict(base_kwargs, **config)
+        key = config_key(kwargs)
+        job_dir = os.path.join(sweep_dir, key)
+        # ports are assigned by position in the sweep, so a rerun gives every config the same ones
+        kwargs['worker_id'] = worker_id
+        worker_id += max(kwargs.get('num_envs', 1), kwargs.get('async_actors', 0), 1)
+        result_fname = os.path.join(job_dir, 'results.json')
+        if os.path.exists(result_fname):
+            continue
+        kwargs['model_dir'] = os.path.join(model_dir, key) if model_dir else os.path.join(job_dir, 'models')
+        kwargs['reports_dir'] = os.path.join(reports_dir, key) if reports_dir else os.path.join(job_dir, 'reports')
+        for d in (kwargs['model_dir'], kwargs['reports_dir']):
+            os.makedirs(os.path.join(d, kwargs['env_type']), exist_ok=True)
+        for d in ('storage_dir', 'checkpoint_dir', 'record_dir'):
+            if kwargs.get(d):
+                kwargs[d] = os.path.join(kwargs[d], key)
+        jobs.append({'key': key, 'config': config, 'kwargs': kwargs, 'threads': threads_per_job,
+                     'result_fname': result_fname})
+
+    print('{} of {} configs to run, {} already done'.format(len(jobs), len(configs), len(configs) - len(jobs)))
+    # fresh spawned processes: Unity environments, CUDA and torch thread pools do not survive a fork well
+    ctx = mp.get_context('spawn')
+    with ctx.Pool(num_workers, maxtasksperchild=1) as pool:
+        for key, results in pool.imap_unordered(_run_job, jobs):
+            index[key] = summarize(results)
+            with open(index_fname + '.tmp', 'w') as f:
+                json.dump(index, f, indent=1)
+            os.replace(index_fname + '.tmp', index_fname)
+            print('{}: {}'.format(key, json.dumps(index[key])))
+    return index
+
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--grid', type=str, nargs='*', default=[],
+                        help='swept train.py params as name=value1,value2,... (values are parsed as JSON if possible)')
+    parser.add_argument('--configs', type=str, default=None,
+                        help='JSON file with a list of configs (dicts of train.py params) to run instead of a grid')
+    parser.add_argument('--sweep_dir', type=str, default='../sweeps/sweep',
+                        help='directory for per-config outputs and the results index')
+    parser.add_argument('--num_workers', type=int, default=2,
+                        help='configs trained concurrently')
+    parser.add_argument('--threads_per_job', type=int, default=1,
+                        help='torch intra-op threads of every training process')
+    args, train_args = parser.parse_known_args()
+    # every other argument is a fixed train.py param shared by all configs
+    base_kwargs = vars(make_parser().parse_args(['sweep'] + train_args))
+
+    if args.configs:
+        with open(args.configs) as f:
+            configs = json.load(f)
+    else:
+        grid = {}
+        for item in args.grid:
+            name, values = item.split('=', 1)
+            grid[name] = [parse_value(v) for v in values.split(',')]
+        configs = expand_grid(grid)
+    run_sweep(configs, base_kwargs, args.sweep_dir, args.num_workers, args.threads_per_job)
@@ -0,0 +1,47 @@
+import torch
+
+
+class TargetUpdater:
+    # Keeps target_net in sync with net without per-step allocations:
+    #   'soft' - Polyak averaging target += tau * (local - target), applied every `every` calls
+    #   'hard' - plain copy of the online weights, applied every `every` calls
+    # Both use multi-tensor in-place ops over all parameters at once where torch provides them.
+    def __init__(self, net, target_net, tau=1e-3, mode='soft', every=1):
+        if mode not in ('soft', 'hard'):
+            raise KeyError('unknown target update mode')
+        self.__local = [p.data for p in net.parameters()]
+        self.__target = [p.data for p in target_net.parameters()]
+        self.__tau = tau
+        self.__mode = mode
+        self.__every = every
+        self.__step_i = 0
+
+    def update(self):
+        self.__step_i += 1
+        if self.__step_i % self.__every != 0:
+            return
+        with torch.no_grad():
+            if self.__mode == 'hard':
+                self._copy()
+            else:
+                self._lerp()
+
+    def state_dict(self):
+        return {'step_i': self.__step_i}
+
+    def load_state_dict(self, state):
+        self.__step_i = state['step_i']
+
+    def _lerp(self):
+        if hasattr(torch, '_foreach_lerp_'):
+            torch._foreach_lerp_(self.__target, self.__local, self.__tau)
+        else:
+            for target, local in zip(self.__target, self.__local):
+                target.lerp_(local, self.__tau)
+
+    def _copy(self):
+        if hasattr(torch, '_foreach_copy_'):
+            torch._foreach_copy_(self.__target, self.__local)
+        else:
+            for target, local in zip(self.__target, self.__local):
+                target.copy_(local)
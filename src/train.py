@@ -1,7 +1,12 @@
-from environment import VisualBananaEnvironment, BananaEnvironment
+from environment import VisualBananaEnvironment, BananaEnvironment, VectorBananaEnvironment, \
+    BatchedSimBananaEnvironment, SimBananaEnvironment
 from agent import DQNAgent, DDQNAgent, DQNAgentPER, DDQNAgentPER
 from neural_net import MlpQNetwork, ConvQNetwork
-from dqn import DQN
+from dqn import DQN, AsyncDQN
+from profiler import PhaseTimer
+from checkpoint import CheckpointWriter, latest_checkpoint, load_checkpoint
+from trajectory import TrajectoryWriter, TrajectoryReader, fill_buffer
+from metrics import TrainingMetrics
 import argparse
 import random
 import matplotlib.pyplot as plt
@@ -12,16 +17,46 @@ import matplotlib as mpl
 mpl.use('TkAgg')  # Mac OS specific
 
 
-def train(**kwargs):
-    kwargs['worker_id'] = 0
+def make_env(**kwargs):
+    if kwargs.get('simulated'):
+        if kwargs['env_type'] not in ('visual', 'simple'):
+            raise KeyError('unknown env type')
+        sim_kwargs = dict(visual=kwargs['env_type'] == 'visual', num_stacked_frames=kwargs['num_stacked_frames'],
+                          dtype=kwargs['frame_dtype'], worker_id=kwargs['worker_id'])
+        if kwargs.get('num_envs', 1) > 1:
+            return BatchedSimBananaEnvironment(num_envs=kwargs['num_envs'], **sim_kwargs)
+        return SimBananaEnvironment(**sim_kwargs)
     if kwargs['env_type'] == 'visual':
-        env = VisualBananaEnvironment(file_name=kwargs['env_file'], num_stacked_frames=kwargs['num_stacked_frames'], worker_id=kwargs['worker_id'])
+        env_cls = VisualBananaEnvironment
+        env_kwargs = dict(file_name=kwargs['env_file'], num_stacked_frames=kwargs['num_stacked_frames'],
+                          dtype=kwargs['frame_dtype'], worker_id=kwargs['worker_id'])
     elif kwargs['env_type'] == 'simple':
-        env = BananaEnvironment(file_name=kwargs['env_file'], worker_id=kwargs['worker_id'])
+        env_cls = BananaEnvironment
+        env_kwargs = dict(file_name=kwargs['env_file'], worker_id=kwargs['worker_id'])
     else:
         raise KeyError('unknown env type')
-    state_dim = env.get_state_dim()
-    action_dim = env.get_action_dim()
+    if kwargs.get('num_envs', 1) > 1:
+        return VectorBananaEnvironment(env_cls=env_cls, num_envs=kwargs['num_envs'], **env_kwargs)
+    return env_cls(**env_kwargs)
+
+
+def train(**kwargs):
+    kwargs['worker_id'] = kwargs.get('worker_id', 0)
+    # checkpoints, recording and profiling are only supported by the episode loop of DQN
+    mode = 'offline_dir' if kwargs.get('offline_dir') else 'async_actors' if kwargs.get('async_actors', 0) > 0 else None
+    unsupported = [name for name in ('checkpoint_dir', 'resume', 'record_dir', 'profile') if kwargs.get(name)]
+    if mode is not None and unsupported:
+        raise ValueError('--{} cannot be combined with --{}'.format(' and --'.join(unsupported), mode))
+    # offline training learns from a recorded trajectory only and never starts an environment
+    offline = TrajectoryReader(kwargs['offline_dir']) if kwargs.get('offline_dir') else None
+    if offline is None:
+        env = make_env(**kwargs)
+        state_dim = env.get_state_dim()
+        action_dim = env.get_action_dim()
+    else:
+        env = None
+        state_dim = offline.meta['state_dim']
+        action_dim = offline.meta['action_dim']
 
     kwargs['device'] = "cuda:0" if torch.cuda.is_available() and kwargs['use_gpu'] else "cpu"
     torch.manual_seed(0)
@@ -38,6 +73,7 @@ def train(**kwargs):
         raise KeyError('unknown env type')
 
     kwargs['action_dim'] = action_dim
+    kwargs['buffer_size'] = kwargs['replay_buffer_size']
 
     if kwargs['agent_type'] == 'ddqn':
         agent = DDQNAgentPER(net, target_net, **kwargs) if kwargs['use_prioritized_buffer'] else DDQNAgent(net, target_net, **kwargs)
@@ -46,28 +82,75 @@ def train(**kwargs):
     else:
         raise KeyError('Unknown agent type')
 
-    dqn = DQN(env=env, agent=agent, **kwargs)
-    scores, losses = dqn.train(kwargs['num_episodes'])
-
-    # save agent
     dt = str(datetime.datetime.now().strftime("%m_%d_%Y_%I_%M_%p"))
     per = 'PER' if kwargs['use_prioritized_buffer'] else ''
+    report_prefix = kwargs['reports_dir']+'/'+kwargs['env_type']+'/{}_agent_{}'.format(kwargs['agent_type'], per)
+
+    timer = PhaseTimer(sync_cuda=True) if kwargs.get('profile') else None
+    checkpointer = None
+    recorder = None
+    # per-episode metrics are streamed to a JSON lines log while training runs
+    metrics_fname = '{}_metrics_{}.jsonl'.format(report_prefix, dt)
+    metrics = TrainingMetrics(metrics_fname)
+    if offline is not None:
+        print('loaded {} transitions from {}'.format(fill_buffer(agent.memory, offline), kwargs['offline_dir']))
+        scores = []
+        if not agent.can_learn():
+            raise ValueError('{} holds {} transitions, fewer than a minibatch'.format(kwargs['offline_dir'],
+                                                                                   agent.memory.size()))
+        losses = [agent.learn() for _ in range(kwargs['offline_updates'])]
+    elif kwargs.get('async_actors', 0) > 0:
+        # every actor thread runs its own single environment on its own worker port
+        env.close()
+        env = None
+        env_fn = lambda i: make_env(**dict(kwargs, worker_id=kwargs['worker_id'] + i, num_envs=1))
+        dqn = AsyncDQN(env_fn=env_fn, agent=agent, num_actors=kwargs['async_actors'], metrics=metrics, **kwargs)
+        scores, losses = dqn.train(kwargs['num_episodes'])
+    else:
+        checkpointer = CheckpointWriter(kwargs['checkpoint_dir']) if kwargs.get('checkpoint_dir') else None
+        if kwargs.get('record_dir'):
+            recorder = TrajectoryWriter(kwargs['record_dir'], env_type=kwargs['env_type'],
+                                        state_dim=np.asarray(state_dim).tolist(), action_dim=action_dim)
+        dqn = DQN(env=env, agent=agent, timer=timer, checkpointer=checkpointer, recorder=recorder, metrics=metrics,
+                  **kwargs)
+        ckpt_fname = latest_checkpoint(kwargs['checkpoint_dir']) if kwargs.get('resume') and checkpointer else None
+        if ckpt_fname is not None:
+            dqn.load_state_dict(load_checkpoint(ckpt_fname))
+            print('resuming from {}'.format(ckpt_fname))
+        scores, losses = dqn.train(kwargs['num_episodes'])
+
+    # save agent
     model_fname = kwargs['model_dir']+'/'+kwargs['env_type']+'/{}_agent_{}_{}.pt'.format(kwargs['agent_type'], per, dt)
     agent.save(model_fname)
 
     # save scores
-    scores_fname = kwargs['reports_dir']+'/'+kwargs['env_type']+'/{}_agent_{}_{}'.format(kwargs['agent_type'], per, dt)
+    scores_fname = '{}_{}'.format(report_prefix, dt)
     np.save(scores_fname, np.array(scores))
 
-    # save scores
-    losses_fname = kwargs['reports_dir']+'/'+kwargs['env_type']+'/{}_agent_{}_loss_{}'.format(kwargs['agent_type'], per, dt)
-    np.save(scores_fname, np.array(losses_fname))
+    # save losses
+    losses_fname = '{}_loss_{}'.format(report_prefix, dt)
+    np.save(losses_fname, np.array(losses))
 
-    env.close()
-    pass
+    # save per-phase timings
+    if timer is not None:
+        timer.dump('{}_timing_{}.json'.format(report_prefix, dt))
 
+    agent.close()
+    metrics.close()
+    if checkpointer is not None:
+        checkpointer.close()
+    if recorder is not None:
+        recorder.close()
+    if env is not None:
+        env.close()
+    return {'scores': [float(s) for s in scores],
+            'losses': [float(l) for l in losses],
+            'model_fname': model_fname,
+            'metrics_fname': metrics_fname,
+            'timing': timer.summary() if timer is not None else {}}
 
-if __name__ == '__main__':
+
+def make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('run_name', type=str, default='Visual Banana Collector',
                         help='tag for current run')
@@ -75,6 +158,8 @@ if __name__ == '__main__':
                         help='file path of Unity environment')
     parser.add_argument('--env_type', type=str,
                         help='visual or simple env')
+    parser.add_argument('--simulated', action='store_true',
+                        help='use the NumPy simulated banana environment instead of Unity')
     parser.add_argument('--model_dir', type=str, default='../data/models',
                         help='basedir for saving model weights')
     parser.add_argument('--reports_dir', type=str, default='../reports',
@@ -84,17 +169,29 @@ if __name__ == '__main__':
                         help='number of episodes to train an agent')
     parser.add_argument('--num_episodes', type=int, default=1000,
                         help='number of episodes to train an agent')
+    parser.add_argument('--num_envs', type=int, default=1,
+                        help='number of environment instances stepped in parallel subprocesses')
     parser.add_argument('--batch_size', type=int, default=64,
                         help='batch size')
     parser.add_argument('--lr', type=float, default=5e-4,
                         help='learning rate')
     parser.add_argument('--num_stacked_frames', type=int, default=4,
                         help='number of frames to stack for state representation')
+    parser.add_argument('--frame_dtype', type=str, default='float32', choices=['uint8', 'float32', 'float64'],
+                        help='dtype of the stacked frames returned by the visual environment')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                        help='bf16 runs the network passes under bfloat16 autocast with float32 master weights; '
+                             'best combined with --frame_dtype uint8')
     # replay buffer params
     parser.add_argument('--replay_buffer_size', type=int, default=10000,
                         help='size of the replay buffer')
+    parser.add_argument('--storage_dir', type=str, default=None,
+                        help='if set, keep the replay buffer in memory-mapped files in this directory; '
+                             'an existing buffer there is reopened')
     parser.add_argument('--use_prioritized_buffer', type=bool, default=False,
                         help='if set True, use prioritized experience replay buffer')
+    parser.add_argument('--replay_shards', type=int, default=1,
+                        help='independent sum-tree shards of the prioritized replay buffer (1 for a single tree)')
     parser.add_argument('--alpha', type=float, default=0.6,
                         help='alpha param for prioritized replay buffer')
     parser.add_argument('--beta', type=float, default=0.0,
@@ -104,8 +201,39 @@ if __name__ == '__main__':
     # dqn params
     parser.add_argument('--tau', type=float, default=1e-3,
                         help='soft update for target networks')
+    parser.add_argument('--target_update', type=str, default='soft', choices=['soft', 'hard'],
+                        help='Polyak averaging (soft) or copying (hard) of the online weights into the target network')
+    parser.add_argument('--target_update_every', type=int, default=1,
+                        help='apply the target update every n learning steps')
     parser.add_argument('--update_every', type=int, default=4,
                         help='update target networks each n steps')
+    parser.add_argument('--gradient_steps', type=int, default=1,
+                        help='gradient steps per update, i.e. the replay ratio is gradient_steps / update_every')
+    parser.add_argument('--prefetch_batches', type=int, default=0,
+                        help='if > 0, sample this many minibatches ahead on a background thread')
+    parser.add_argument('--async_actors', type=int, default=0,
+                        help='if > 0, collect experience with this many actor threads while learning asynchronously')
+    parser.add_argument('--replay_ratio', type=float, default=0.25,
+                        help='gradient updates per environment step in asynchronous mode')
+    parser.add_argument('--sync_every', type=int, default=100,
+                        help='env steps between syncs of the actor networks in asynchronous mode')
+    parser.add_argument('--quantize_actors', type=str, default=None, choices=['dynamic', 'static'],
+                        help='in asynchronous mode, act with int8 CPU copies of the actor networks; static also '
+                             'quantizes the convolutions but re-calibrates at every sync')
+    parser.add_argument('--checkpoint_dir', type=str, default=None,
+                        help='if set, write full training checkpoints to this directory in the background')
+    parser.add_argument('--checkpoint_every', type=int, default=50,
+                        help='write a checkpoint every n episodes')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume training from the latest checkpoint in --checkpoint_dir')
+    parser.add_argument('--record_dir', type=str, default=None,
+                        help='if set, stream every observed transition into a trajectory in this directory')
+    parser.add_argument('--offline_dir', type=str, default=None,
+                        help='if set, train offline from the trajectory in this directory instead of an environment')
+    parser.add_argument('--offline_updates', type=int, default=100000,
+                        help='gradient updates in offline training')
+    parser.add_argument('--profile', action='store_true',
+                        help='report per-phase wall times every episode and save them at the end of training')
     # agent params
     parser.add_argument('--init_epsilon', type=float, default=1.0,
                         help='initial epsilon of the e-greedy policy')
@@ -115,12 +243,17 @@ if __name__ == '__main__':
                         help='minimum of the epsilon')
     parser.add_argument('-gamma', type=float, default=0.99,
                         help='discount factor')
+    parser.add_argument('--n_step', type=int, default=1,
+                        help='steps of the discounted returns stored in the replay buffer (1 for one-step TD targets)')
     # q_net params
     parser.add_argument('--hidden_size', type=int, default=128,
                         help='size of the hidden layer')
     parser.add_argument('--use_gpu', type=bool, default=True,
                         help='whether use gpu or not')
+    return parser
 
-    args = parser.parse_args()
+
+if __name__ == '__main__':
+    args = make_parser().parse_args()
     train(**vars(args))
 
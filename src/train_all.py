@@ -1,68 +1,77 @@
-from train import train
+from sweep import run_sweep
 import argparse
-import time
 
-def main(**kwargs):
-    banana_env_fname = "../Banana_env/Banana.exe"
-    visual_banana_env_fname = "../VisualBanana_env/Banana.exe"
-
-    algs = ['dqn', 'dqn']
-    per = [True, True]
+ENV_FILES = {'simple': "../Banana_env/Banana.exe",
+             'visual': "../VisualBanana_env/Banana.exe"}
 
-    kwargs['num_episodes'] = 1000
-
-    kwargs['worker_id'] = 0
-    # run simple banana
 
-    kwargs['env_type'] = 'simple'
-    kwargs['env_file'] = banana_env_fname
+def str2bool(value):
+    return value.lower() in ('true', '1', 'yes')
 
-    for a in algs:
-        kwargs['agent_type'] = a
-        for p in per:
-            kwargs['use_prioritized_buffer'] = p
-            print('-----Train config: \nEnv: {} \nAgent type: {} \nPER: {}\n\n'
-                  .format(kwargs['env_type'], kwargs['agent_type'], kwargs['use_prioritized_buffer']))
-            train(**kwargs)
-            time.sleep(2)
-            kwargs['worker_id'] += 1
 
-    # run visual banana
-    kwargs['env_type'] = 'visual'
-    kwargs['env_file'] = visual_banana_env_fname
-    for a in algs:
-        kwargs['agent_type'] = a
-        for p in per:
-            kwargs['use_prioritized_buffer'] = p
-            print('\n\n\n--------Train config--------: \nEnv: {} \nAgent type: {} \nPER: {}\n'
-                  . format(kwargs['env_type'], kwargs['agent_type'], kwargs['use_prioritized_buffer']))
-            train(**kwargs)
-            kwargs['worker_id'] += 1
+def main(**kwargs):
+    # every (env_type, agent_type, PER) combination is one config of a sweep
+    env_types, agent_types, per_options = kwargs.pop('env_types'), kwargs.pop('agent_types'), kwargs.pop('per_options')
+    # the single-config flags of earlier versions narrow the sweep to that agent type / PER option
+    agent_type, use_prioritized_buffer = kwargs.pop('agent_type'), kwargs.pop('use_prioritized_buffer')
+    if agent_type is not None:
+        agent_types = [agent_type]
+    if use_prioritized_buffer is not None:
+        per_options = [use_prioritized_buffer]
+    configs = [{'env_type': env_type, 'env_file': ENV_FILES[env_type], 'agent_type': agent_type,
+                'use_prioritized_buffer': per}
+               for env_type in env_types for agent_type in agent_types for per in per_options]
+    sweep_dir, num_workers, threads_per_job = kwargs.pop('sweep_dir'), kwargs.pop('num_workers'), kwargs.pop('threads_per_job')
+    model_dir, reports_dir = kwargs.pop('model_dir'), kwargs.pop('reports_dir')
+    kwargs['worker_id'] = 0
+    run_sweep(configs, kwargs, sweep_dir, num_workers, threads_per_job, model_dir=model_dir, reports_dir=reports_dir)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
 
     parser.add_argument('--model_dir', type=str, default='../data/models',
-                        help='basedir for saving model weights')
+                        help='basedir for saving model weights, one subdirectory per run')
     parser.add_argument('--reports_dir', type=str, default='../reports',
-                        help='basedir for saving training reports')
+                        help='basedir for saving training reports, one subdirectory per run')
+    parser.add_argument('--sweep_dir', type=str, default='../sweeps/train_all',
+                        help='directory for the results index and the results of every run')
+    parser.add_argument('--num_workers', type=int, default=2,
+                        help='runs trained concurrently')
+    parser.add_argument('--threads_per_job', type=int, default=1,
+                        help='torch intra-op threads of every training process')
+    parser.add_argument('--env_types', type=str, nargs='+', default=['simple', 'visual'],
+                        help='environments to train in')
+    parser.add_argument('--agent_types', type=str, nargs='+', default=['dqn'],
+                        help='agent types to train: dqn, ddqn')
+    parser.add_argument('--agent_type', type=str, default=None,
+                        help='if set, train only this agent type (same as --agent_types with one value)')
+    parser.add_argument('--per_options', type=str2bool, nargs='+', default=[True],
+                        help='whether to use the prioritized replay buffer, e.g. true false')
+    parser.add_argument('--use_prioritized_buffer', type=str2bool, default=None,
+                        help='if set, train only with (true) or without (false) the prioritized replay buffer')
     # train params
-    parser.add_argument('--agent_type', type=str, default='dqn',
-                        help='number of episodes to train an agent')
     parser.add_argument('--num_episodes', type=int, default=1000,
                         help='number of episodes to train an agent')
+    parser.add_argument('--num_envs', type=int, default=1,
+                        help='number of environment instances stepped in parallel subprocesses')
     parser.add_argument('--batch_size', type=int, default=100,
                         help='batch size')
     parser.add_argument('--lr', type=float, default=1e-4,
                         help='learning rate')
     parser.add_argument('--num_stacked_frames', type=int, default=4,
                         help='number of frames to stack for state representation')
+    parser.add_argument('--frame_dtype', type=str, default='float32', choices=['uint8', 'float32', 'float64'],
+                        help='dtype of the stacked frames returned by the visual environment')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                        help='bf16 runs the network passes under bfloat16 autocast with float32 master weights')
     # replay buffer params
     parser.add_argument('--replay_buffer_size', type=int, default=100000,
                         help='size of the replay buffer')
-    parser.add_argument('--use_prioritized_buffer', type=bool, default=False,
-                        help='if set True, use prioritized experience replay buffer')
+    parser.add_argument('--storage_dir', type=str, default=None,
+                        help='if set, keep the replay buffers in memory-mapped files under this directory')
+    parser.add_argument('--replay_shards', type=int, default=1,
+                        help='independent sum-tree shards of the prioritized replay buffer (1 for a single tree)')
     parser.add_argument('--alpha', type=float, default=0.6,
                         help='alpha param for prioritized replay buffer')
     parser.add_argument('--beta', type=float, default=0.01,
@@ -72,9 +81,23 @@ if __name__ == '__main__':
     # dqn params
     parser.add_argument('--tau', type=float, default=1e-3,
                         help='soft update for target networks')
+    parser.add_argument('--target_update', type=str, default='soft', choices=['soft', 'hard'],
+                        help='Polyak averaging (soft) or copying (hard) of the online weights into the target network')
+    parser.add_argument('--target_update_every', type=int, default=1,
+                        help='apply the target update every n learning steps')
     parser.add_argument('--update_every', type=int, default=4,
                         help='update target networks each n steps')
+    parser.add_argument('--gradient_steps', type=int, default=1,
+                        help='gradient steps per update, i.e. the replay ratio is gradient_steps / update_every')
+    parser.add_argument('--prefetch_batches', type=int, default=0,
+                        help='if > 0, sample this many minibatches ahead on a background thread')
     # agent params
+    parser.add_argument('--checkpoint_dir', type=str, default=None,
+                        help='if set, write full training checkpoints under this directory in the background')
+    parser.add_argument('--checkpoint_every', type=int, default=50,
+                        help='write a checkpoint every n episodes')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume every run from its latest checkpoint under --checkpoint_dir')
     parser.add_argument('--init_epsilon', type=float, default=1.0,
                         help='initial epsilon of the e-greedy policy')
     parser.add_argument('--epsilon_decay', type=float, default=0.99,
@@ -83,6 +106,8 @@ if __name__ == '__main__':
                         help='minimum of the epsilon')
     parser.add_argument('-gamma', type=float, default=0.99,
                         help='discount factor')
+    parser.add_argument('--n_step', type=int, default=1,
+                        help='steps of the discounted returns stored in the replay buffer (1 for one-step TD targets)')
     # q_net params
     parser.add_argument('--hidden_size', type=int, default=128,
                         help='size of the hidden layer')
@@ -0,0 +1,169 @@
+import json
+import os
+import queue
+import shutil
+import threading
+import numpy as np
+
+from replay_buffer import _item_shape
+
+COLUMNS = ('states', 'actions', 'rewards', 'next_states', 'dones', 'env_ids')
+
+
+class TrajectoryWriter:
+    # Streams transitions into directory as a sequence of columnar chunks of chunk_size transitions. A chunk is
+    # either one compressed .npz file (compress=True) or a directory of plain .npy files that readers can memory-map.
+    # Full chunks are written by a background thread; every chunk appears under its final name only once complete
+    # and meta.json is rewritten after each one, so a crashed recording stays readable up to its last chunk.
+    # Extra keyword arguments (e.g. env_type, state_dim, action_dim) are stored in meta.json.
+    def __init__(self, directory, chunk_size=10000, compress=True, **meta):
+        if os.path.exists(os.path.join(directory, 'meta.json')):
+            raise FileExistsError('{} already holds a trajectory'.format(directory))
+        os.makedirs(directory, exist_ok=True)
+        self.__directory = directory
+        self.__chunk_size = chunk_size
+        self.__compress = compress
+        self.__meta = dict(meta, compressed=compress, chunks=[], chunk_sizes=[])
+        self.__columns = None
+        self.__size = 0
+        # at most two full chunks wait for the writer thread
+        self.__queue = queue.Queue(maxsize=2)
+        self.__error = None
+        self.__thread = threading.Thread(target=self._run, daemon=True)
+        self.__thread.start()
+
+    def _allocate(self, state_shape, state_dtype):
+        n = self.__chunk_size
+        self.__columns = (np.zeros((n,) + tuple(state_shape), dtype=state_dtype),
+                          np.zeros(n, dtype=np.int64),
+                          np.zeros(n, dtype=np.float32),
+                          np.zeros((n,) + tuple(state_shape), dtype=state_dtype),
+                          np.zeros(n, dtype=np.bool_),
+                          np.zeros(n, dtype=np.int64))
+        self.__size = 0
+
+    def add(self, state, action, reward, next_state, done, env_id=0):
+        if self.__columns is None:
+            self._allocate(_item_shape(state), np.asarray(state).dtype)
+        states, actions, rewards, next_states, dones, env_ids = self.__columns
+        i = self.__size
+        states[i] = np.reshape(state, states.shape[1:])
+        actions[i] = action
+        rewards[i] = reward
+        next_states[i] = np.reshape(next_state, next_states.shape[1:])
+        dones[i] = done
+        env_ids[i] = env_id
+        self.__size += 1
+        if self.__size == self.__chunk_size:
+            self._submit()
+
+    def add_batch(self, states, actions, rewards, next_states, dones, env_ids=None):
+        env_ids = np.zeros(len(actions), dtype=np.int64) if env_ids is None else env_ids
+        start = 0
+        while start < len(actions):
+            if self.__columns is None:
+                self._allocate(np.shape(states)[1:], np.asarray(states).dtype)
+            n = min(self.__chunk_size - self.__size, len(actions) - start)
+            for column, values in zip(self.__columns, (states, actions, rewards, next_states, dones, env_ids)):
+                column[self.__size:self.__size + n] = np.reshape(values[start:start + n],
+                                                                 (n,) + column.shape[1:])
+            self.__size += n
+            start += n
+            if self.__size == self.__chunk_size:
+                self._submit()
+
+    def _submit(self):
+        if self.__error is not None:
+            raise self.__error
+        if self.__size > 0:
+            self.__queue.put(tuple(column[:self.__size] for column in self.__columns))
+        # the next chunk gets fresh arrays, the submitted ones belong to the writer thread now
+        self.__columns = None
+        self.__size = 0
+
+    def _run(self):
+        while True:
+            columns = self.__queue.get()
+            if columns is None:
+                return
+            try:
+                self._write_chunk(columns)
+            except Exception as e:
+                self.__error = e
+            finally:
+                self.__queue.task_done()
+
+    def _write_chunk(self, columns):
+        name = 'chunk_{:06d}'.format(len(self.__meta['chunks']))
+        path = os.path.join(self.__directory, name)
+        if self.__compress:
+            name += '.npz'
+            with open(path + '.npz.tmp', 'wb') as f:
+                np.savez_compressed(f, **dict(zip(COLUMNS, columns)))
+            os.replace(path + '.npz.tmp', path + '.npz')
+        else:
+            shutil.rmtree(path + '.tmp', ignore_errors=True)
+            os.makedirs(path + '.tmp')
+            for column, values in zip(COLUMNS, columns):
+                np.save(os.path.join(path + '.tmp', column + '.npy'), values)
+            os.replace(path + '.tmp', path)
+        self.__meta['chunks'].append(name)
+        self.__meta['chunk_sizes'].append(len(columns[1]))
+        with open(os.path.join(self.__directory, 'meta.json.tmp'), 'w') as f:
+            json.dump(self.__meta, f, indent=1)
+        os.replace(os.path.join(self.__directory, 'meta.json.tmp'), os.path.join(self.__directory, 'meta.json'))
+
+    def close(self):
+        # writes the partial last chunk and waits for all chunks to be on disk
+        self._submit()
+        self.__queue.put(None)
+        self.__thread.join()
+        if self.__error is not None:
+            raise self.__error
+
+
+class TrajectoryReader:
+    # Lazy reader of a TrajectoryWriter directory: chunks are loaded one at a time, uncompressed chunks are
+    # memory-mapped when mmap is set.
+    def __init__(self, directory, mmap=True):
+        self.__directory = directory
+        self.__mmap = mmap
+        with open(os.path.join(directory, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+    def __len__(self):
+        return sum(self.meta['chunk_sizes'])
+
+    def num_chunks(self):
+        return len(self.meta['chunks'])
+
+    def chunk(self, i):
+        # the columns of chunk i in COLUMNS order
+        path = os.path.join(self.__directory, self.meta['chunks'][i])
+        if self.meta['compressed']:
+            with np.load(path) as f:
+                return tuple(f[column] for column in COLUMNS)
+        mmap_mode = 'r' if self.__mmap else None
+        return tuple(np.load(os.path.join(path, column + '.npy'), mmap_mode=mmap_mode) for column in COLUMNS)
+
+    def chunks(self):
+        for i in range(self.num_chunks()):
+            yield self.chunk(i)
+
+    def __iter__(self):
+        # transition by transition, as (state, action, reward, next_state, done, env_id)
+        for columns in self.chunks():
+            for i in range(len(columns[1])):
+                yield tuple(column[i] for column in columns)
+
+
+def fill_buffer(memory, reader, limit=None):
+    # bulk-loads the transitions of reader (at most limit of them) into a replay buffer, one chunk per call
+    num_added = 0
+    for states, actions, rewards, next_states, dones, env_ids in reader.chunks():
+        n = len(actions) if limit is None else min(len(actions), limit - num_added)
+        if n <= 0:
+            break
+        memory.add_batch(states[:n], actions[:n], rewards[:n], next_states[:n], dones[:n], env_ids[:n])
+        num_added += n
+    return num_added